@@ -0,0 +1,306 @@
+import json
+import math
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec(object):
+    name = 'json'
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, payload):
+        return json.loads(payload.decode('utf-8'))
+
+
+class MsgpackCodec(object):
+    name = 'msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise NotImplementedError('msgpack is not installed.')
+
+    def dumps(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+CODECS = {
+    'json': JsonCodec,
+    'msgpack': MsgpackCodec,
+}
+
+
+def get_codec(name):
+    if name not in CODECS:
+        raise NotImplementedError('Unknown cache codec {}.'.format(name))
+    return CODECS[name]()
+
+
+def approx_size(value):
+    """Rough number of bytes held by a cache value."""
+    if isinstance(value, (str, bytes)):
+        return len(value) + 48
+    if isinstance(value, dict):
+        return 64 + sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return 56 + sum(approx_size(v) for v in value)
+    return 24
+
+
+class MemoryCache(object):
+    """Cache entries kept inside this worker.
+
+    The cache holds at most ``max_entries`` entries and roughly
+    ``max_bytes`` of data (``0`` means no limit), evicting the least
+    recently used entries first.  Entries past their expiry are swept at
+    most every ``sweep_seconds`` while storing new entries.  Entries can be
+    stored with tags and purged by tag.
+    """
+
+    def __init__(self, max_entries=0, max_bytes=0, sweep_seconds=60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sweep_seconds = sweep_seconds
+        self.data = OrderedDict()
+        self._sizes = {}
+        self._expires = {}
+        self._tags = {}
+        self._key_tags = {}
+        self._bytes = 0
+        self._last_sweep = time.time()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self.data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def get_field(self, key, field):
+        # Read one item of an entry without counting it as a hit.
+        entry = self.data.get(key)
+        return entry.get(field) if entry is not None else None
+
+    def set(self, key, entry, expire_at, tags=()):
+        size = approx_size(entry)
+        with self._lock:
+            self._remove(key)
+            if self.max_bytes and size > self.max_bytes:
+                return
+            self.data[key] = entry
+            self._sizes[key] = size
+            self._expires[key] = expire_at
+            self._bytes += size
+            if tags:
+                self._key_tags[key] = tuple(tags)
+                for tag in tags:
+                    self._tags.setdefault(tag, set()).add(key)
+            now = time.time()
+            if now - self._last_sweep >= self.sweep_seconds:
+                self._sweep(now)
+            while self.data and ((self.max_entries and len(self.data) > self.max_entries) or
+                                 (self.max_bytes and self._bytes > self.max_bytes)):
+                self._remove(next(iter(self.data)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        if key in self.data:
+            del self.data[key]
+            del self._expires[key]
+            self._bytes -= self._sizes.pop(key)
+            for tag in self._key_tags.pop(key, ()):
+                keys = self._tags[tag]
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def _sweep(self, now):
+        self._last_sweep = now
+        for key in [k for k, v in self._expires.items() if v < now]:
+            self._remove(key)
+            self.expirations += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def keys(self, prefix=''):
+        with self._lock:
+            return [k for k in self.data.keys() if k.startswith(prefix)]
+
+    def purge_tags(self, tags):
+        # Deletes every entry stored with any of the tags, returns how many.
+        with self._lock:
+            keys = set()
+            for tag in tags:
+                keys.update(self._tags.get(tag, ()))
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self.data.clear()
+            self._sizes.clear()
+            self._expires.clear()
+            self._tags.clear()
+            self._key_tags.clear()
+            self._bytes = 0
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.data)
+
+    def stats(self):
+        return {
+            'entries': len(self.data),
+            'bytes': self._bytes,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+class RedisCache(object):
+    """Cache entries shared by every worker through Redis.
+
+    Each entry is stored as a Redis hash with one field per entry item.
+    ``bytes`` values are stored as they are, everything else goes through
+    the codec.  Values of at least ``compress_min_bytes`` are zlib
+    compressed (``0`` turns compression off).  Every field starts with a
+    one byte marker saying how it was encoded.  The keys stored with a tag
+    are kept in a Redis sorted set scored by their expiry, expired keys are
+    dropped from it whenever a key is added and the set itself lives for
+    ``tag_ttl`` seconds after the last key was added to it.
+    """
+
+    RAW = b'b'
+    CODEC = b'c'
+
+    def __init__(self, redis_db, codec=None, compress_min_bytes=0,
+                 prefix='fastpass|', tag_ttl=86400):
+        self.redis_db = redis_db
+        self.codec = codec if codec is not None else JsonCodec()
+        self.compress_min_bytes = compress_min_bytes
+        self.prefix = prefix
+        self.tag_ttl = tag_ttl
+        self.hits = 0
+        self.misses = 0
+
+    def _pack(self, value):
+        if isinstance(value, bytes):
+            flag, payload = self.RAW, value
+        else:
+            flag, payload = self.CODEC, self.codec.dumps(value)
+        if self.compress_min_bytes and len(payload) >= self.compress_min_bytes:
+            flag, payload = flag.upper(), zlib.compress(payload)
+        return flag + payload
+
+    def _unpack(self, packed):
+        flag, payload = packed[:1], packed[1:]
+        if flag.isupper():
+            flag, payload = flag.lower(), zlib.decompress(payload)
+        if flag == self.RAW:
+            return payload
+        return self.codec.loads(payload)
+
+    def get(self, key):
+        raw = self.redis_db.hgetall(self.prefix + key)
+        if not raw:
+            self.misses += 1
+            return None
+        try:
+            entry = {k.decode('utf-8'): self._unpack(v) for k, v in raw.items()}
+        except Exception:
+            # Written by another codec or corrupted, treat it as a miss.
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def get_field(self, key, field):
+        packed = self.redis_db.hget(self.prefix + key, field)
+        if packed is None:
+            return None
+        try:
+            return self._unpack(packed)
+        except Exception:
+            return None
+
+    def _tag_key(self, tag):
+        return '{}tag|{}'.format(self.prefix, tag)
+
+    def set(self, key, entry, expire_at, tags=()):
+        redis_key = self.prefix + key
+        pipe = self.redis_db.pipeline()
+        pipe.delete(redis_key)
+        pipe.hset(redis_key, mapping={k: self._pack(v) for k, v in entry.items()})
+        pipe.expireat(redis_key, int(math.ceil(expire_at)))
+        now = time.time()
+        for tag in tags:
+            pipe.zremrangebyscore(self._tag_key(tag), '-inf', now)
+            pipe.zadd(self._tag_key(tag), {key: expire_at})
+            pipe.expire(self._tag_key(tag), self.tag_ttl)
+        pipe.execute()
+
+    def delete(self, key):
+        self.redis_db.delete(self.prefix + key)
+
+    def keys(self, prefix=''):
+        pattern = re.sub(r'([*?\[\]\\])', r'\\\1', self.prefix + prefix) + '*'
+        offset = len(self.prefix)
+        return [k.decode('utf-8')[offset:] for k in self.redis_db.scan_iter(match=pattern)]
+
+    def purge_tags(self, tags):
+        tag_keys = [self._tag_key(tag) for tag in tags]
+        if not tag_keys:
+            return 0
+        pipe = self.redis_db.pipeline()
+        now = time.time()
+        for tag_key in tag_keys:
+            pipe.zrangebyscore(tag_key, now, '+inf')
+        keys = set()
+        for members in pipe.execute():
+            keys.update(members)
+        pipe = self.redis_db.pipeline()
+        for key in keys:
+            pipe.delete(self.prefix + key.decode('utf-8'))
+        pipe.delete(*tag_keys)
+        pipe.execute()
+        return len(keys)
+
+    def clear(self):
+        for key in self.keys():
+            self.delete(key)
+
+    def snapshot(self):
+        return {}
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+        }
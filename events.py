@@ -0,0 +1,130 @@
+import queue
+import threading
+import time
+
+
+def format_event(topic, body):
+    lines = body.decode('utf-8').rstrip('\n').split('\n')
+    return 'event: {}\n{}\n\n'.format(topic, '\n'.join('data: ' + x for x in lines))
+
+
+class _Subscriber(object):
+    def __init__(self, topics, max_pending):
+        self.topics = topics
+        self.queue = queue.Queue(maxsize=max_pending)
+
+
+class EventHub(object):
+    """Pushes changes of cache entries to Server-Sent Events streams.
+
+    ``sources`` maps a topic to a function returning its current cache
+    entry.  One thread per worker polls the topics somebody is subscribed
+    to, each again when its entry expires (but at most every
+    ``min_interval`` seconds, or ``retry_seconds`` after a failure), and
+    sends the body to the subscribers of the topic whenever its etag
+    changed.  Streams get a comment every ``heartbeat_seconds`` to keep the
+    connection open.  Subscribers that fall ``max_pending`` events behind
+    are dropped.
+    """
+
+    def __init__(self, sources, min_interval=1, retry_seconds=30, heartbeat_seconds=15,
+                 max_clients=1000, max_pending=20):
+        self.sources = sources
+        self.min_interval = min_interval
+        self.retry_seconds = retry_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.max_clients = max_clients
+        self.max_pending = max_pending
+        self.latest = {}
+        self.published = 0
+        self._next_poll = {}
+        self._subscribers = set()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def subscribe(self, topics):
+        """Returns a subscriber for ``topics``, or ``None`` when full."""
+        subscriber = _Subscriber(topics, self.max_pending)
+        with self._cond:
+            if len(self._subscribers) >= self.max_clients:
+                return None
+            self._subscribers.add(subscriber)
+            for topic in topics:
+                if topic in self.latest:
+                    subscriber.queue.put_nowait(self.latest[topic][1])
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='event-hub', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._cond:
+            self._subscribers.discard(subscriber)
+
+    def stream(self, subscriber):
+        try:
+            while True:
+                try:
+                    event = subscriber.queue.get(timeout=self.heartbeat_seconds)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                if event is None:
+                    return
+                yield event
+        finally:
+            self.unsubscribe(subscriber)
+
+    def _publish(self, topic, etag, event):
+        with self._cond:
+            self.latest[topic] = (etag, event)
+            self.published += 1
+            for subscriber in list(self._subscribers):
+                if topic not in subscriber.topics:
+                    continue
+                try:
+                    subscriber.queue.put_nowait(event)
+                except queue.Full:
+                    self._subscribers.discard(subscriber)
+                    # Ends the stream once the client reads this far.
+                    subscriber.queue = queue.Queue()
+                    subscriber.queue.put_nowait(None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                topics = set()
+                for subscriber in self._subscribers:
+                    topics.update(subscriber.topics)
+                if not topics:
+                    self._cond.wait()
+                    continue
+            now = time.time()
+            for topic in topics:
+                if self._next_poll.get(topic, 0) <= now:
+                    self._next_poll[topic] = self.poll(topic, now)
+            with self._cond:
+                self._cond.wait(max(0, min(self._next_poll[x] for x in topics) - time.time()))
+
+    def poll(self, topic, now=None):
+        """Polls one topic, publishing its entry if it changed, and returns when to poll it next."""
+        now = now if now is not None else time.time()
+        try:
+            entry = self.sources[topic]()
+        except Exception as e:
+            print('Polling {} for events failed: {}'.format(topic, e))
+            return now + self.retry_seconds
+        if entry is None:
+            return now + self.retry_seconds
+        current = self.latest.get(topic)
+        if current is None or current[0] != entry['etag']:
+            self._publish(topic, entry['etag'], format_event(topic, entry['body']))
+        return max(entry['expire_at'], now + self.min_interval)
+
+    def stats(self):
+        return {
+            'clients': len(self._subscribers),
+            'topics': sorted(self.latest),
+            'published': self.published,
+        }
@@ -1,29 +1,49 @@
 # import time
 
 import os
+import re
 from datetime import datetime, timedelta, timezone
 from dateutil import parser
 import html
+import gzip
+import hashlib
 import json
 import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 from urllib.parse import urlparse
 
 import requests
 import redis
 from ftfy import fix_text
-from flask import Flask, jsonify, request, redirect
+from flask import Flask, Response, g, has_request_context, jsonify, request, redirect
 from jinja2 import Environment, PackageLoader
 from flask_cors import CORS
-from bs4 import BeautifulSoup
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 from youtube import YoutubeBroadcasts
-from slack import SlackMessenger
+from slack import RedisDedup, SlackMessenger, SlackQueue, SqliteDedup
+from singleflight import SingleFlight
+from upstream import UpstreamClient
+from warmer import CacheWarmer
+from events import EventHub
+from formatting import format_wp_post, project_podcast_post
+from cache import MemoryCache, RedisCache, get_codec
+from powerpress import remove_player
+from search import SearchIndex
+from sync import ChangeIndex, make_cursor, parse_cursor
 
 
 def _setup_appflags():
     url = 'https://wdwnt.com/wp-json/wp/v2/appflag'
     try:
-        response = requests.get(url, headers=WP_HEADER)
+        response = http_client.get(url, headers=WP_HEADER)
         response_data = response.json()
         result = dict([(x['id'], x['slug']) for x in response_data])
         return result
@@ -33,7 +53,49 @@ def _setup_appflags():
 
 CACHE_EXPIRE_SECONDS = os.getenv('FASTPASS_CACHE_EXPIRE_SECONDS', 180)
 CACHE_SYSTEM = os.getenv('FASTPASS_CACHE_SYSTEM', 'memory')
-TIMEOUT_SECONDS = os.getenv('FASTPASS_TIMEOUT_SECONDS', 5)
+CACHE_STALE_SECONDS = int(os.getenv('FASTPASS_CACHE_STALE_SECONDS', 0))
+CACHE_REFRESH_WORKERS = int(os.getenv('FASTPASS_CACHE_REFRESH_WORKERS', 4))
+CACHE_CODEC = os.getenv('FASTPASS_CACHE_CODEC', 'json')
+CACHE_COMPRESS_MIN_BYTES = int(os.getenv('FASTPASS_CACHE_COMPRESS_MIN_BYTES', 0))
+CACHE_MAX_ENTRIES = int(os.getenv('FASTPASS_CACHE_MAX_ENTRIES', 2000))
+CACHE_MAX_BYTES = int(os.getenv('FASTPASS_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+RESPONSE_COMPRESS_MIN_BYTES = int(os.getenv('FASTPASS_RESPONSE_COMPRESS_MIN_BYTES', 1024))
+RESPONSE_BROTLI_QUALITY = int(os.getenv('FASTPASS_RESPONSE_BROTLI_QUALITY', 5))
+FORMAT_WORKERS = int(os.getenv('FASTPASS_FORMAT_WORKERS', 0))
+FORMAT_POOL = os.getenv('FASTPASS_FORMAT_POOL', 'process')
+FORMAT_MIN_POSTS = int(os.getenv('FASTPASS_FORMAT_MIN_POSTS', 20))
+WARMER_ENABLED = os.getenv('FASTPASS_WARMER_ENABLED', '').lower() in ('1', 'true', 'yes')
+WARM_PATHS = [x for x in os.getenv('FASTPASS_WARM_PATHS',
+                                   '/posts,/podcasts,/announcements,/notifications,/live365,'
+                                   '/wdwnt/broadcasts,/upnt/broadcasts,/entertainment/broadcasts').split(',') if x]
+WARM_TOP_N = int(os.getenv('FASTPASS_WARM_TOP_N', 20))
+WARM_INTERVAL_SECONDS = int(os.getenv('FASTPASS_WARM_INTERVAL_SECONDS', 10))
+WARM_LEAD_SECONDS = int(os.getenv('FASTPASS_WARM_LEAD_SECONDS', 20))
+WARM_JITTER_SECONDS = int(os.getenv('FASTPASS_WARM_JITTER_SECONDS', 10))
+WARM_CONCURRENCY = int(os.getenv('FASTPASS_WARM_CONCURRENCY', 2))
+TIMEOUT_SECONDS = float(os.getenv('FASTPASS_TIMEOUT_SECONDS', 5))
+CONNECT_TIMEOUT_SECONDS = float(os.getenv('FASTPASS_CONNECT_TIMEOUT_SECONDS', 3.05))
+HTTP_POOL_SIZE = int(os.getenv('FASTPASS_HTTP_POOL_SIZE', 10))
+HTTP_RETRIES = int(os.getenv('FASTPASS_HTTP_RETRIES', 2))
+HTTP_BACKOFF_FACTOR = float(os.getenv('FASTPASS_HTTP_BACKOFF_FACTOR', 0.3))
+BATCH_MAX_PATHS = int(os.getenv('FASTPASS_BATCH_MAX_PATHS', 10))
+BATCH_WORKERS = int(os.getenv('FASTPASS_BATCH_WORKERS', 6))
+SYNC_INDEX_SIZE = int(os.getenv('FASTPASS_SYNC_INDEX_SIZE', 1000))
+SYNC_EXPIRE_SECONDS = int(os.getenv('FASTPASS_SYNC_EXPIRE_SECONDS', 30))
+SYNC_MAX_PAGES = int(os.getenv('FASTPASS_SYNC_MAX_PAGES', 5))
+SYNC_OVERLAP_SECONDS = int(os.getenv('FASTPASS_SYNC_OVERLAP_SECONDS', 300))
+SYNC_WINDOW_SECONDS = int(os.getenv('FASTPASS_SYNC_WINDOW_SECONDS', 7 * 86400))
+# Same variable gunicorn.conf.py reads.
+WORKER_CLASS = os.getenv('FASTPASS_WORKER_CLASS', 'sync')
+EVENTS_MIN_INTERVAL_SECONDS = float(os.getenv('FASTPASS_EVENTS_MIN_INTERVAL_SECONDS', 1))
+EVENTS_HEARTBEAT_SECONDS = float(os.getenv('FASTPASS_EVENTS_HEARTBEAT_SECONDS', 15))
+EVENTS_MAX_CLIENTS = int(os.getenv('FASTPASS_EVENTS_MAX_CLIENTS', 1000))
+SEARCH_INDEX_SIZE = int(os.getenv('FASTPASS_SEARCH_INDEX_SIZE', 1000))
+SEARCH_INDEX_CONTENT = os.getenv('FASTPASS_SEARCH_INDEX_CONTENT', '').lower() in ('1', 'true', 'yes')
+UPSTREAM_REVALIDATE = os.getenv('FASTPASS_UPSTREAM_REVALIDATE', 'true').lower() in ('1', 'true', 'yes')
+UPSTREAM_KEEP_SECONDS = int(os.getenv('FASTPASS_UPSTREAM_KEEP_SECONDS', 3600))
+WP_PROJECTION_ENABLED = os.getenv('FASTPASS_WP_PROJECTION_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+ENTITY_PREFETCH = os.getenv('FASTPASS_ENTITY_PREFETCH', '').lower() in ('1', 'true', 'yes')
 SERVER_PORT = os.getenv('FASTPASS_HOST_PORT', 5000)
 POSTS_PER_PAGE = os.getenv('FASTPASS_POSTS_PER_PAGE', 30)
 YOUTUBE_VIDS_PER_PAGE = os.getenv('FASTPASS_YOUTUBE_VIDS_PER_PAGE', 30)
@@ -52,6 +114,12 @@ BROADCAST_ENTERTAINMENT_CLIENT_SECRET = os.getenv('FASTPASS_BROADCAST_ENTERTAINM
 BROADCAST_ENTERTAINMENT_REFRESH_TOKEN = os.getenv('FASTPASS_BROADCAST_ENTERTAINMENT_REFRESH_TOKEN', '')
 BROADCAST_EXPIRE_SECONDS = os.getenv('FASTPASS_BROADCAST_EXPIRE_SECONDS', 600)
 UNLISTED_VIDEO_EXPIRE_SECONDS = os.getenv('FASTPASS_UNLISTED_VIDEO_EXPIRE_SECONDS', 300)
+SLACK_BATCH_SIZE = int(os.getenv('FASTPASS_SLACK_BATCH_SIZE', 10))
+SLACK_BATCH_SECONDS = float(os.getenv('FASTPASS_SLACK_BATCH_SECONDS', 2))
+SLACK_RETRIES = int(os.getenv('FASTPASS_SLACK_RETRIES', 5))
+SLACK_BACKOFF_SECONDS = float(os.getenv('FASTPASS_SLACK_BACKOFF_SECONDS', 1))
+SLACK_DEDUP_SECONDS = int(os.getenv('FASTPASS_SLACK_DEDUP_SECONDS', 604800))
+SLACK_DEDUP_PATH = os.getenv('FASTPASS_SLACK_DEDUP_PATH', '/tmp/fastpass-slack.sqlite3')
 LIVE365_EXPIRE_SECONDS = os.getenv('FASTPASS_LIVE365_EXPIRE_SECONDS', 30)
 INSTAGRAM_EXPIRE_SECONDS = os.getenv('FASTPASS_INSTAGRAM_EXPIRE_SECONDS', 450)
 NTUNES_AUDIO_URL = os.getenv('FASTPASS_NTUNES_AUDIO_URL', '')
@@ -59,12 +127,18 @@ REDIS_HOST = os.getenv('FASTPASS_REDIS_HOST', '127.0.0.1')
 REDIS_PORT = os.getenv('FASTPASS_REDIS_PORT', 36379)
 REDIS_PASSWORD = os.getenv('FASTPASS_REDIS_PASSWORD', '')
 REDIS_USE_SSL = os.getenv('FASTPASS_REDIS_USE_SSL', False)
+SINGLE_FLIGHT_LOCK_SECONDS = int(os.getenv('FASTPASS_SINGLE_FLIGHT_LOCK_SECONDS', 30))
 GIT_COMMIT = os.getenv('HEROKU_SLUG_COMMIT', None)
 GIT_RELEASE_AT = os.getenv('HEROKU_RELEASE_CREATED_AT', None)
 GIT_DESCRIPTION = os.getenv('HEROKU_SLUG_DESCRIPTION', None)
 WP_HEADER = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) '
                            'AppleWebKit/537.36 (KHTML, like Gecko) '
                            'Chrome/50.0.2661.102 Safari/537.36'}
+http_client = UpstreamClient(pool_size=HTTP_POOL_SIZE,
+                             connect_timeout=CONNECT_TIMEOUT_SECONDS,
+                             read_timeout=TIMEOUT_SECONDS,
+                             retries=HTTP_RETRIES,
+                             backoff_factor=HTTP_BACKOFF_FACTOR)
 WP_APPFLAGS = _setup_appflags()
 
 app = Flask(__name__, static_folder='static/')
@@ -72,11 +146,37 @@ CORS(app)
 err_env = Environment(loader=PackageLoader('fastpass', 'error_responses'))
 err_env.filters['jsonify'] = json.dumps
 
-mem_cache = {}
 redis_db = redis.StrictRedis(host=REDIS_HOST,
                              port=REDIS_PORT,
                              password=REDIS_PASSWORD,
                              ssl=REDIS_USE_SSL)
+if CACHE_SYSTEM == 'redis':
+    cache = RedisCache(redis_db, codec=get_codec(CACHE_CODEC),
+                       compress_min_bytes=CACHE_COMPRESS_MIN_BYTES)
+else:
+    cache = MemoryCache(max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES)
+single_flight = SingleFlight(redis_db if CACHE_SYSTEM == 'redis' else None,
+                             lock_timeout=SINGLE_FLIGHT_LOCK_SECONDS)
+refresh_executor = ThreadPoolExecutor(max_workers=CACHE_REFRESH_WORKERS)
+refreshing_keys = set()
+refreshing_lock = threading.Lock()
+fill_state = threading.local()
+format_executor = None
+format_executor_lock = threading.Lock()
+search_index = SearchIndex(max_docs=SEARCH_INDEX_SIZE) if SEARCH_INDEX_SIZE and SEARCH_INDEX_CONTENT else None
+youtube_clients = {}
+youtube_clients_lock = threading.Lock()
+change_index = ChangeIndex(max_posts=SYNC_INDEX_SIZE)
+wp_gmt_offset = {'hours': None, 'checked_at': 0}
+try:
+    slack_queue = SlackQueue(SlackMessenger(http=http_client),
+                             dedup=(RedisDedup(redis_db, ttl=SLACK_DEDUP_SECONDS) if CACHE_SYSTEM == 'redis'
+                                    else SqliteDedup(SLACK_DEDUP_PATH, ttl=SLACK_DEDUP_SECONDS)),
+                             batch_size=SLACK_BATCH_SIZE, batch_seconds=SLACK_BATCH_SECONDS,
+                             retries=SLACK_RETRIES, backoff_seconds=SLACK_BACKOFF_SECONDS)
+except NotImplementedError:
+    # No webhook configured.
+    slack_queue = None
 
 
 def format_airtime(in_data):
@@ -117,55 +217,40 @@ def format_live365(in_data):
     return result
 
 
-def format_wp(in_data, with_content=False, with_player=True):
-    result = []
-    for post in in_data:
-        raw_url = urlparse(post.get('guid', {}).get('rendered', ''))
-        obj = dict(author={})
-        obj['id'] = post.get('id')
-        obj['short_URL'] = 'https://{}/?p={}'.format(raw_url.netloc, obj['id'])
-        obj['title'] = html.unescape(post.get('title', {}).get('rendered', ''))
-        obj['date'] = post.get('date_gmt')
-        authors = post.get('_embedded', {}).get('author', [])
-        obj['author']['name'] = ','.join([x.get('name', '') for x in authors])
-
-        media = post.get('_embedded', {}).get('wp:featuredmedia', [])
-        if media:
-            obj['featured_image'] = media[0].get('source_url')
-        else:
-            obj['featured_image'] = ''
-
-        term = post.get('_embedded', {}).get('wp:term', [])
-        if term:
-            try:
-                term_val = term[0][0].get('name', '')
-                obj['category'] = html.unescape(term_val)
-            except KeyError:
-                obj['category'] = ''
-        else:
-            obj['category'] = ''
-
-        if with_content:
-            raw_content = post.get('content', {}).get('rendered', '')
-            if with_player:
-                obj['content'] = raw_content
+def _get_format_executor():
+    global format_executor
+    with format_executor_lock:
+        if format_executor is None:
+            if FORMAT_POOL == 'thread':
+                format_executor = ThreadPoolExecutor(max_workers=FORMAT_WORKERS)
             else:
-                content, media_url = remove_player(raw_content)
-                obj['content'] = content
-                obj['media_url'] = media_url
-        result.append(obj)
-    return result
+                # The formatters live in formatting.py, which is all the
+                # processes import whichever way they are started.
+                format_executor = ProcessPoolExecutor(max_workers=FORMAT_WORKERS)
+        return format_executor
+
+
+def _format_all(func, items, **kwargs):
+    # Formats items in order, fanning large lists out to the format pool.
+    global format_executor
+    func = partial(func, **kwargs)
+    if not FORMAT_WORKERS or len(items) < FORMAT_MIN_POSTS:
+        return [func(x) for x in items]
+    chunksize = max(1, len(items) // (FORMAT_WORKERS * 4))
+    try:
+        return list(_get_format_executor().map(func, items, chunksize=chunksize))
+    except BrokenProcessPool:
+        with format_executor_lock:
+            format_executor = None
+        return [func(x) for x in items]
 
 
-def remove_player(wp_content):
-    soup = BeautifulSoup(wp_content, "html.parser")
+def format_wp(in_data, with_content=False, with_player=True):
+    return _format_all(format_wp_post, in_data, with_content=with_content, with_player=with_player)
 
-    download_url = soup.find('a', class_='powerpress_link_d').get('href', '')
-    for tag in soup.select('div.powerpress_player'):
-        tag.decompose()
-    for tag in soup.select('p.powerpress_links'):
-        tag.decompose()
-    return str(soup), download_url
+
+def _project_podcast_posts(posts, with_content=True, with_player=True):
+    return _format_all(project_podcast_post, posts, with_content=with_content, with_player=with_player)
 
 
 def format_wp_single_post(in_data, with_player=True, with_icon=False):
@@ -253,37 +338,468 @@ def format_youtube(in_data):
     return result
 
 
+# Fields each formatter reads, requested through WordPress' _fields/_embed
+# projections instead of the full _embed payload.
+WP_EMBEDS = ('author', 'wp:featuredmedia', 'wp:term')
+WP_LIST_FIELDS = ('id', 'slug', 'guid', 'title', 'date_gmt', 'modified_gmt', 'categories', 'tags',
+                  '_links', '_embedded')
+WP_SINGLE_FIELDS = ('id', 'slug', 'title', 'date_gmt', 'content', 'acf', 'jetpack-related-posts',
+                    '_links', '_embedded')
+# With ENTITY_PREFETCH lists also fetch what the single view needs, so that
+# it can be served from the entity store after a list refresh.
+WP_ENTITY_FIELDS = tuple(dict.fromkeys(WP_LIST_FIELDS + (WP_SINGLE_FIELDS if ENTITY_PREFETCH else ())))
+# Unfiltered post lists also fetch what WordPress searches, for the local
+# search index.
+WP_SEARCH_FIELDS = ('content', 'excerpt')
+WP_NOTIFICATION_FIELDS = ('id', 'type', 'date_gmt', 'title', 'excerpt',
+                          'app_notification_category', 'app_notification_type')
+wp_projection_unsupported = set()
+
+
+def _wp_projection(url, fields, embed=()):
+    base, _, query = url.partition('?')
+    params = [x for x in query.split('&') if x and x != '_embed']
+    if embed:
+        params.append('_embed=' + ','.join(embed))
+    params.append('_fields=' + ','.join(fields))
+    return base + '?' + '&'.join(params)
+
+
+def _wp_projection_ok(data, embed):
+    for item in (data if isinstance(data, list) else [data]):
+        if not isinstance(item, dict) or 'id' not in item:
+            return False
+        if embed and item.get('_links', {}).get('author') and '_embedded' not in item:
+            return False
+    return True
+
+
+class NotModified(Exception):
+    """The upstream response an entry was made from has not changed."""
+
+    def __init__(self, entry):
+        super().__init__('Not modified')
+        self.entry = entry
+
+
+def _upstream_get(key, url, **kwargs):
+    # GETs url to fill the cache entry key.  While key is being filled the
+    # ETag/Last-Modified of the response its current entry was made from
+    # are sent, and a 304 or an identical body raises NotModified so the
+    # entry is kept without decoding or formatting anything.  The new
+    # validators are picked up by _store_in_cache().
+    validators = getattr(fill_state, 'validators', {})
+    if not UPSTREAM_REVALIDATE or key not in validators:
+        return http_client.get(url, **kwargs)
+    # Read directly: entries with validators outlive stale_until so that
+    # they can still be revalidated.
+    entry = cache.get(key)
+    previous = entry.get('upstream') if entry is not None else None
+    if previous is not None and previous['url'] != url:
+        previous = None
+    if previous is not None:
+        headers = dict(kwargs.pop('headers', None) or {})
+        if previous['etag']:
+            headers['If-None-Match'] = previous['etag']
+        if previous['last_modified']:
+            headers['If-Modified-Since'] = previous['last_modified']
+        kwargs['headers'] = headers
+    response = http_client.get(url, **kwargs)
+    if response.status_code == 304 and previous is not None:
+        raise NotModified(entry)
+    if response.status_code == 200:
+        body_hash = hashlib.sha1(response.content).hexdigest()
+        if previous is not None and previous['hash'] == body_hash:
+            raise NotModified(entry)
+        validators[key] = {'url': url, 'hash': body_hash, 'etag': response.headers.get('ETag'),
+                           'last_modified': response.headers.get('Last-Modified')}
+    return response
+
+
+def _wp_get(url, fields, embed=WP_EMBEDS, key=None):
+    # Fetches url with only the given fields and embeds and returns the
+    # decoded JSON and status code.  Hosts where the projection fails but
+    # the full url works get the full url from then on.  key is the cache
+    # entry being filled, if any.
+    host = urlparse(url).netloc
+    projection_failed = False
+    if WP_PROJECTION_ENABLED and host not in wp_projection_unsupported:
+        response = _upstream_get(key, _wp_projection(url, fields, embed), headers=WP_HEADER)
+        if response.status_code == 404:
+            return response.json(), response.status_code
+        if response.status_code < 400:
+            try:
+                data = response.json()
+            except ValueError:
+                data = None
+            if data is not None and _wp_projection_ok(data, embed):
+                return data, response.status_code
+        projection_failed = True
+    response = _upstream_get(key, url, headers=WP_HEADER)
+    if projection_failed and response.status_code < 400:
+        print('WordPress projection unsupported by {}, using full responses'.format(host))
+        wp_projection_unsupported.add(host)
+    return response.json(), response.status_code
+
+
+def _make_entry(data, expire_at=0, stale_until=0, stored_at=None, compress=True):
+    # Responses are encoded once, the same way jsonify() would, and served
+    # as bytes on every hit.  Entries served only once skip the compressed
+    # copies with compress=False.
+    if isinstance(data, str):
+        body = data.encode('utf-8')
+        mimetype = 'text/html; charset=utf-8'
+    else:
+        body = (json.dumps(data, sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8')
+        mimetype = 'application/json'
+    entry = {
+        'body': body,
+        'etag': hashlib.sha1(body).hexdigest(),
+        'mimetype': mimetype,
+        'stored_at': stored_at if stored_at is not None else datetime.now(timezone.utc).timestamp(),
+        'expire_at': expire_at,
+        'stale_until': stale_until,
+    }
+    # Compressed copies are made once here so hits only pick one.
+    if compress and RESPONSE_COMPRESS_MIN_BYTES and len(body) >= RESPONSE_COMPRESS_MIN_BYTES:
+        entry['gzip'] = gzip.compress(body, mtime=0)
+        if brotli is not None:
+            # The default quality 11 is far too slow for the miss path.
+            entry['br'] = brotli.compress(body, quality=RESPONSE_BROTLI_QUALITY)
+    return entry
+
+
+def _entry_data(entry):
+    if entry['mimetype'] == 'application/json':
+        return json.loads(entry['body'])
+    return entry['body'].decode('utf-8')
+
+
+def _cached_response(entry):
+    # Clients may reuse the body until the entry expires and revalidate it
+    # with If-None-Match / If-Modified-Since afterwards.
+    now = datetime.now(timezone.utc).timestamp()
+    encodings = [x for x in ('br', 'gzip') if x in entry]
+    encoding = request.accept_encodings.best_match(encodings) if encodings else None
+    if encoding:
+        response = Response(entry[encoding], mimetype=entry['mimetype'])
+        response.content_encoding = encoding
+        response.set_etag('{}-{}'.format(entry['etag'], encoding))
+    else:
+        response = Response(entry['body'], mimetype=entry['mimetype'])
+        response.set_etag(entry['etag'])
+    if encodings:
+        response.vary.add('Accept-Encoding')
+    response.last_modified = datetime.fromtimestamp(int(entry['stored_at']), timezone.utc)
+    response.cache_control.max_age = max(0, int(entry['expire_at'] - now))
+    return response.make_conditional(request)
+
+
 def _store_in_cache(url, data, expire_time=None,
-                    expire_seconds=CACHE_EXPIRE_SECONDS):
+                    expire_seconds=CACHE_EXPIRE_SECONDS,
+                    stale_seconds=CACHE_STALE_SECONDS, tags=()):
     if not expire_time:
         expiry = datetime.utcnow() + timedelta(seconds=expire_seconds)
         expiry = expiry.replace(tzinfo=timezone.utc)
     else:
         expiry = expire_time
 
-    if CACHE_SYSTEM == 'redis':
-        redis_db.set(url, data, expire_seconds)
-    else:
-        val = {
-            'data': data,
-            'expire_at': expiry.timestamp(),
-        }
-        mem_cache[url] = val
+    val = _make_entry(data, expiry.timestamp(), expiry.timestamp() + stale_seconds)
+    upstream = getattr(fill_state, 'validators', {}).get(url)
+    if upstream is not None:
+        val['upstream'] = upstream
+    if tags:
+        # Kept so that revalidated entries are stored with them again.
+        val['tags'] = list(tags)
+    entities = getattr(fill_state, 'entities', {}).get(url)
+    if entities:
+        val['entities'] = entities
+    cache.set(url, val, _retain_until(val), tags=tags)
+    return val
+
+
+def _retain_until(entry):
+    # Entries made from a response with validators are kept for
+    # UPSTREAM_KEEP_SECONDS after they go stale, to send the validators
+    # and to serve the body again on a 304.
+    if UPSTREAM_REVALIDATE and 'upstream' in entry:
+        return entry['stale_until'] + UPSTREAM_KEEP_SECONDS
+    return entry['stale_until']
+
+
+def _extend_entry(url, entry, expire_seconds=CACHE_EXPIRE_SECONDS,
+                  stale_seconds=CACHE_STALE_SECONDS):
+    entry = dict(entry)
+    entry['expire_at'] = datetime.now(timezone.utc).timestamp() + expire_seconds
+    entry['stale_until'] = entry['expire_at'] + stale_seconds
+    cache.set(url, entry, _retain_until(entry), tags=entry.get('tags', ()))
+    # The raw posts and slugs stored with it did not change either.
+    for key in entry.get('entities', ()):
+        record = cache.get(key)
+        if record is not None:
+            cache.set(key, dict(record, expire_at=entry['expire_at']), _retain_until(entry),
+                      tags=record.get('tags', ()))
+    return entry
+
+
+def _entry_expiry(entry):
+    return datetime.fromtimestamp(entry['expire_at'], timezone.utc)
+
+
+def _store_projection(url, data, canonical):
+    # Projections expire with the entry they were made from.  One made from
+    # a stale entry is served without storing it, stored it would already be
+    # expired and every request would project again in the background until
+    # the refresh of the canonical entry lands.
+    if canonical['expire_at'] < datetime.now(timezone.utc).timestamp():
+        return _make_entry(data, canonical['expire_at'], canonical['stale_until'], compress=False)
+    return _store_in_cache(url, data, expire_time=_entry_expiry(canonical))
+
+
+def _get_cache_entry(url, include_old=True):
+    # Entries live until stale_until, callers decide what to do with stale data.
+    now = datetime.utcnow()
+    now = now.replace(tzinfo=timezone.utc)
+    entry = cache.get(url)
+    if entry is None:
+        return None
+    if entry['stale_until'] < now.timestamp():
+        if 'upstream' not in entry:
+            cache.delete(url)
+        return None
+    if entry['expire_at'] >= now.timestamp() or include_old:
+        return entry
+    return None
+
+
+def _get_fresh_entry(url, min_seconds):
+    # The entry if it is still fresh for at least min_seconds.
+    entry = _get_cache_entry(url, include_old=False)
+    if entry is None or entry['expire_at'] < datetime.now(timezone.utc).timestamp() + min_seconds:
+        return None
+    return entry
 
 
 def _get_from_cache(url, include_old=False):
-    now = datetime.utcnow()
-    now = now.replace(tzinfo=timezone.utc)
-    if CACHE_SYSTEM == 'redis':
-        redis_db.get(url)
+    entry = _get_cache_entry(url, include_old=include_old)
+    if entry is None:
+        return None
+    return _entry_data(entry)
+
+
+def _wp_tags(post_type, posts, *extra):
+    # Tags used by /purge: the post type, every post in the entry and the
+    # categories and tags of those posts.
+    tags = [post_type] + list(extra)
+    for post in (posts if isinstance(posts, list) else [posts]):
+        if isinstance(post, dict) and 'id' in post:
+            tags.append('{}:{}'.format(post_type, post['id']))
+            tags.extend('category:{}'.format(x) for x in post.get('categories', []))
+            tags.extend('tag:{}'.format(x) for x in post.get('tags', []))
+    return list(dict.fromkeys(tags))
+
+
+def _list_tags(post_type, posts, categories=''):
+    # Unfiltered lists change whenever a post of their type does, category
+    # lists when a post of one of their categories does.
+    if categories:
+        extra = ['category:{}'.format(x) for x in categories.split(',') if x]
     else:
-        if url not in mem_cache:
-            return None
-        if mem_cache[url]['expire_at'] >= now.timestamp() or include_old:
-            return mem_cache[url]['data']
-        else:
-            del mem_cache[url]
-            return None
+        extra = ['{}:list'.format(post_type)]
+    return _wp_tags(post_type, posts, *extra)
+
+
+def _entity_key(url, post_type, post_id):
+    return 'entity|{}|{}|{}'.format(urlparse(url).netloc, post_type, post_id)
+
+
+def _index_posts(posts):
+    # Adds list-formatted posts to the local change and search indexes.
+    for post in posts:
+        item = format_wp_post(post)
+        if post.get('modified_gmt'):
+            change_index.add(item['id'], post['modified_gmt'], item)
+        # WordPress searches the title, excerpt and content, posts fetched
+        # without them are left as they are.
+        if search_index is None or not all(x in post for x in WP_SEARCH_FIELDS):
+            continue
+        fields = {'title': item['title']}
+        for field in WP_SEARCH_FIELDS:
+            text = post.get(field, {}).get('rendered', '')
+            fields[field] = html.unescape(re.sub(r'<[^>]+>', ' ', text))
+        search_index.add(item['id'], item['date'] or '', item, fields)
+
+
+def _slug_key(url, post_type, slug):
+    return 'slug|{}|{}|{}'.format(urlparse(url).netloc, post_type, slug)
+
+
+def _pick(obj, keys):
+    return {k: obj[k] for k in keys if k in obj}
+
+
+def _entity_post(post):
+    # The parts of a WordPress post that format_wp(), format_wp_single_post()
+    # and the cache tags read.
+    entity = _pick(post, ('id', 'slug', 'guid', 'title', 'date_gmt', 'modified_gmt', 'categories', 'tags',
+                          'content'))
+    if 'acf' in post:
+        entity['acf'] = _pick(post['acf'] or {}, ('app_menu_icon',))
+    if 'jetpack-related-posts' in post:
+        entity['jetpack-related-posts'] = [_pick(x, ('id', 'title', 'img'))
+                                           for x in post['jetpack-related-posts'] or []]
+    embedded = post.get('_embedded', {})
+    entity['_embedded'] = {
+        'author': [dict(_pick(x, ('id', 'name', 'description')),
+                        avatar_urls=_pick(x.get('avatar_urls', {}), ('96',)))
+                   for x in embedded.get('author', [])],
+        'wp:featuredmedia': [_pick(x, ('source_url',)) for x in embedded.get('wp:featuredmedia', [])[:1]],
+        'wp:term': [[_pick(x, ('name',)) for x in terms[:1]] for terms in embedded.get('wp:term', [])[:1]],
+    }
+    return entity
+
+
+def _store_entities(url, post_type, posts, fields, expire_seconds=CACHE_EXPIRE_SECONDS):
+    # WordPress posts are kept once per site, type and id, so list and
+    # single post requests share them.  fields records what was requested.
+    # Slugs are indexed to the post id for ?slug= lookups.
+    if isinstance(posts, dict):
+        posts = [posts]
+    if not isinstance(posts, list):
+        return
+    expiry = datetime.utcnow() + timedelta(seconds=expire_seconds)
+    expire_at = expiry.replace(tzinfo=timezone.utc).timestamp()
+    # The entry being filled from url owns these records and extends them
+    # when it is revalidated, so they are kept as long as it is.
+    owned = getattr(fill_state, 'entities', {}).get(url)
+    retain_until = expire_at + CACHE_STALE_SECONDS
+    if UPSTREAM_REVALIDATE and owned is not None and getattr(fill_state, 'validators', {}).get(url) is not None:
+        retain_until += UPSTREAM_KEEP_SECONDS
+    for post in posts:
+        if isinstance(post, dict) and 'id' in post:
+            tags = _wp_tags(post_type, post)
+            records = [(_entity_key(url, post_type, post['id']),
+                        {'post': _entity_post(post), 'fields': list(fields), 'expire_at': expire_at,
+                         'tags': tags})]
+            if post.get('slug'):
+                records.append((_slug_key(url, post_type, post['slug']),
+                                {'id': post['id'], 'expire_at': expire_at, 'tags': tags}))
+            for key, record in records:
+                cache.set(key, record, retain_until, tags=tags)
+                if owned is not None:
+                    owned.append(key)
+    if post_type == 'posts' and set(WP_LIST_FIELDS) <= set(fields):
+        _index_posts([x for x in posts if isinstance(x, dict) and 'id' in x])
+
+
+def _get_entity(url, post_type, post_id, fields):
+    entity = cache.get(_entity_key(url, post_type, post_id))
+    if entity is None or entity['expire_at'] < datetime.now(timezone.utc).timestamp():
+        return None
+    if not set(fields) <= set(entity['fields']):
+        return None
+    return entity['post']
+
+
+def _wp_get_single(url, post_type, post_id, expire_seconds=CACHE_EXPIRE_SECONDS):
+    post = _get_entity(url, post_type, post_id, WP_SINGLE_FIELDS)
+    if post is not None:
+        return post, 200
+    post, status_code = _wp_get(url, WP_SINGLE_FIELDS, key=url)
+    if status_code < 400:
+        _store_entities(url, post_type, post, WP_SINGLE_FIELDS, expire_seconds=expire_seconds)
+    return post, status_code
+
+
+def _wp_get_list(url, post_type, slug='', fields=WP_ENTITY_FIELDS, expire_seconds=CACHE_EXPIRE_SECONDS):
+    if slug:
+        index = cache.get(_slug_key(url, post_type, slug))
+        if index is not None and index['expire_at'] >= datetime.now(timezone.utc).timestamp():
+            post = _get_entity(url, post_type, index['id'], WP_LIST_FIELDS)
+            if post is not None and post.get('slug') == slug:
+                return [post], 200
+    posts, status_code = _wp_get(url, fields, key=url)
+    if status_code < 400:
+        _store_entities(url, post_type, posts, fields, expire_seconds=expire_seconds)
+    return posts, status_code
+
+
+def _refresh_in_background(url, fill):
+    with refreshing_lock:
+        if url in refreshing_keys:
+            return
+        refreshing_keys.add(url)
+
+    def refresh():
+        try:
+            single_flight.do(url, fill, recheck=lambda: _get_cache_entry(url, include_old=False))
+        except Exception as e:
+            print('Background refresh of {} failed: {}'.format(url, e))
+        finally:
+            with refreshing_lock:
+                refreshing_keys.discard(url)
+
+    refresh_executor.submit(refresh)
+
+
+def _cached_fetch(url, fetch, expire_seconds=CACHE_EXPIRE_SECONDS, store=True, tags=()):
+    # Only one caller per key runs fetch() on a miss, the rest get its result.
+    # Between expire_at and stale_until the old entry is served while a
+    # background worker refreshes it.  With store=False fetch() stores the
+    # entry itself and returns it.  When fetch() finds the upstream response
+    # unchanged the current entry is kept for another expire_seconds.
+    def fill():
+        if not hasattr(fill_state, 'validators'):
+            fill_state.validators = {}
+            fill_state.entities = {}
+        fill_state.validators[url] = None
+        fill_state.entities[url] = []
+        try:
+            if store:
+                return _store_in_cache(url, fetch(), expire_seconds=expire_seconds, tags=tags)
+            return fetch()
+        except NotModified as e:
+            return _extend_entry(url, e.entry, expire_seconds=expire_seconds)
+        finally:
+            fill_state.validators.pop(url, None)
+            fill_state.entities.pop(url, None)
+
+    if has_request_context():
+        refresh = g.get('fastpass_refresh', False)
+        if not g.get('fastpass_recorded', False):
+            # Entries derived from other entries only count the outer key.
+            g.fastpass_recorded = True
+            cache_warmer.record(request.full_path.rstrip('?'), url, hit=not refresh)
+        if refresh:
+            # Skipped when another worker refreshed the entry in the meantime.
+            lead = cache_warmer.lead_seconds + cache_warmer.jitter_seconds
+            return single_flight.do(url, fill, recheck=lambda: _get_fresh_entry(url, lead))
+
+    entry = _get_cache_entry(url)
+    if entry is not None:
+        now = datetime.utcnow().replace(tzinfo=timezone.utc)
+        if entry['expire_at'] < now.timestamp():
+            _refresh_in_background(url, fill)
+        return entry
+
+    return single_flight.do(url, fill, recheck=lambda: _get_cache_entry(url, include_old=False))
+
+
+def _warm_path(path):
+    # Run the route for path as if requested, bypassing the cached entry.
+    with app.test_request_context(path):
+        g.fastpass_refresh = True
+        app.dispatch_request()
+
+
+cache_warmer = CacheWarmer(_warm_path, lambda key: cache.get_field(key, 'expire_at'),
+                           paths=WARM_PATHS, top_n=WARM_TOP_N,
+                           interval=WARM_INTERVAL_SECONDS,
+                           lead_seconds=WARM_LEAD_SECONDS,
+                           jitter_seconds=WARM_JITTER_SECONDS,
+                           concurrency=WARM_CONCURRENCY)
+if WARMER_ENABLED:
+    cache_warmer.start()
 
 
 def _get_error_json(path, cache_time=CACHE_EXPIRE_SECONDS):
@@ -307,65 +823,99 @@ def _get_error_json(path, cache_time=CACHE_EXPIRE_SECONDS):
 
 def _clear_cache(status):
     if status == 'NOT_FULL_OF_SHIT':
-        if CACHE_SYSTEM == 'redis':
-            redis_db.flushall()
-            return True
-        else:
-            mem_cache.clear()
-            return True
+        cache.clear()
+        return True
     return False
 
 
 def _clear_posts(status):
-    prefix = 'https://wdwnt.com/wp-json/wp/v2/posts'
     if status == 'NOT_FULL_OF_SHIT':
-        if CACHE_SYSTEM == 'redis':
-            for key in redis_db.scan_iter(prefix + '*'):
-                redis_db.delete(key)
-            return True
-        else:
-            to_del = set()
-            for k in mem_cache.keys():
-                if k.startswith(prefix):
-                    to_del.add(k)
-            for l in to_del:
-                mem_cache.pop(l)
-            return True
+        cache.purge_tags(['posts'])
+        return True
     return False
 
 
+def _purge_ids(ids):
+    if not isinstance(ids, list) or not all(isinstance(x, (int, str)) and str(x).isdigit() for x in ids):
+        raise ValueError('Invalid ids {}'.format(ids))
+    return [int(x) for x in ids]
+
+
+def _purge(status, data):
+    # data names what changed: {"posts": [ids], "pages": [ids],
+    # "cpt": {type: [ids]}, "categories": [ids], "tags": [ids]}.
+    # Raises ValueError when it is not in that shape.
+    if status != 'NOT_FULL_OF_SHIT':
+        return None
+    changed = [('posts', x) for x in _purge_ids(data.get('posts', []))]
+    changed += [('pages', x) for x in _purge_ids(data.get('pages', []))]
+    cpts = data.get('cpt', {})
+    if not isinstance(cpts, dict):
+        raise ValueError('Invalid cpt {}'.format(cpts))
+    for cpt_type, ids in cpts.items():
+        changed += [(cpt_type, x) for x in _purge_ids(ids)]
+    tags = ['category:{}'.format(x) for x in _purge_ids(data.get('categories', []))]
+    tags += ['tag:{}'.format(x) for x in _purge_ids(data.get('tags', []))]
+    for post_type, post_id in changed:
+        tags += ['{}:{}'.format(post_type, post_id), '{}:list'.format(post_type)]
+        if post_type == 'posts' and search_index is not None:
+            search_index.remove(post_id)
+    return cache.purge_tags(list(dict.fromkeys(tags)))
+
+
+def _youtube_client(site_code, client_id, client_secret, refresh_token):
+    # One long lived client per site code, rebuilt if its credentials change.
+    credentials = (client_id, client_secret, refresh_token)
+    with youtube_clients_lock:
+        client, client_credentials = youtube_clients.get(site_code, (None, None))
+        if client is None or client_credentials != credentials:
+            client = YoutubeBroadcasts(client_id, client_secret, refresh_token)
+            youtube_clients[site_code] = (client, credentials)
+        return client
+
+
 def _unlisted_videos(site_code: str, client_id: str, client_secret: str, refresh_token: str):
     in_delta_minutes = int(request.args.get('delta_minutes', UNLISTED_VIDEO_EXPIRE_SECONDS / 60))
     if not (client_id and client_secret and refresh_token):
         return jsonify({})
-    response_list = _get_from_cache(f'unlisted_videos_{site_code}')
-    if not response_list:
-        yb = YoutubeBroadcasts(client_id, client_secret, refresh_token)
+
+    def fetch():
+        yb = _youtube_client(site_code, client_id, client_secret, refresh_token)
         response_list = yb.get_unlisted_videos(in_delta_minutes)
-        _store_in_cache(f'unlisted_videos_{site_code}', response_list, expire_seconds=UNLISTED_VIDEO_EXPIRE_SECONDS)
-        sm = SlackMessenger()
+        entry = _store_in_cache(f'unlisted_videos_{site_code}', response_list,
+                                expire_seconds=UNLISTED_VIDEO_EXPIRE_SECONDS)
+        if slack_queue is None:
+            return entry
         for video in response_list:
             slack_msg = 'A new video has been uploaded to the {} YouTube Channel and may need a cover image.' \
                         ' {} https://www.youtube.com/watch?v={}'
             msg = slack_msg.format(site_code.upper(), video['title'], video['id'])
-            sm.send(msg, f'youtube-{site_code}', 'YouTube Unlisted FastPass ZapBot', ':youtube:')
-    return jsonify(response_list)
+            slack_queue.enqueue(msg, f'youtube-{site_code}', 'YouTube Unlisted FastPass ZapBot', ':youtube:',
+                                key=f'unlisted|{site_code}|{video["id"]}')
+        return entry
 
+    entry = _cached_fetch(f'unlisted_videos_{site_code}', fetch, store=False)
+    return _cached_response(entry)
 
-def _broadcasts(site_code: str, client_id: str, client_secret: str, refresh_token: str):
-    if not (client_id and client_secret and refresh_token):
-        return jsonify({})
-    response_dict = _get_from_cache(f'broadcasts_{site_code}')
-    if not response_dict:
-        yb = YoutubeBroadcasts(client_id, client_secret, refresh_token)
+
+def _broadcasts_entry(site_code: str, client_id: str, client_secret: str, refresh_token: str):
+    def fetch():
+        yb = _youtube_client(site_code, client_id, client_secret, refresh_token)
         response_dict = yb.get_broadcasts()
         old_response = _get_from_cache(f'broadcasts_{site_code}', include_old=True)
         old_response = {} if old_response is None else old_response
         all_upcoming = response_dict['upcoming'] + old_response.get('upcoming', [])
         response_dict['upcoming'] = list({v['id']: v for v in all_upcoming if v['id'] not in
                                           [x['id'] for x in response_dict['live']]}.values())
-        _store_in_cache(f'broadcasts_{site_code}', response_dict, expire_seconds=BROADCAST_EXPIRE_SECONDS)
-    return jsonify(response_dict)
+        return response_dict
+
+    return _cached_fetch(f'broadcasts_{site_code}', fetch, expire_seconds=BROADCAST_EXPIRE_SECONDS)
+
+
+def _broadcasts(site_code: str, client_id: str, client_secret: str, refresh_token: str):
+    if not (client_id and client_secret and refresh_token):
+        return jsonify({})
+    return _cached_response(_broadcasts_entry(site_code, client_id, client_secret, refresh_token))
 
 
 # Video
@@ -384,12 +934,12 @@ def youtube():
     if page_token:
         url += '&pageToken={}'.format(page_token)
 
-    response_dict = _get_from_cache(url)
-    if not response_dict:
-        response = requests.get(url)
-        response_dict = format_youtube(response.json())
-        _store_in_cache(url, response_dict)
-    return jsonify(response_dict)
+    def fetch():
+        response = _upstream_get(url, url)
+        return format_youtube(response.json())
+
+    entry = _cached_fetch(url, fetch)
+    return _cached_response(entry)
 
 
 @app.route('/broadcasts', strict_slashes=False)
@@ -416,24 +966,26 @@ def entertainment_broadcasts():
 def wigs_broadcasts():
     if not (BROADCAST_CLIENT_ID and BROADCAST_CLIENT_SECRET and BROADCAST_REFRESH_TOKEN):
         return jsonify({})
-    response_dict = _get_from_cache('broadcasts/unlisted')
-    if not response_dict:
-        yb = YoutubeBroadcasts(BROADCAST_CLIENT_ID, BROADCAST_CLIENT_SECRET, BROADCAST_REFRESH_TOKEN)
+
+    def fetch():
+        yb = _youtube_client('wdwnt', BROADCAST_CLIENT_ID, BROADCAST_CLIENT_SECRET, BROADCAST_REFRESH_TOKEN)
         response_dict = yb.get_broadcasts(show_unlisted=True)
         old_response = _get_from_cache('broadcasts', include_old=True)
         old_response = {} if old_response is None else old_response
         all_upcoming = response_dict['upcoming'] + old_response.get('upcoming', [])
         response_dict['upcoming'] = list({v['id']: v for v in all_upcoming if v['id'] not in
                                           [x['id'] for x in response_dict['live']]}.values())
-        _store_in_cache('broadcasts/unlisted', response_dict, expire_seconds=BROADCAST_EXPIRE_SECONDS)
-    return jsonify(response_dict)
+        return response_dict
+
+    entry = _cached_fetch('broadcasts/unlisted', fetch, expire_seconds=BROADCAST_EXPIRE_SECONDS)
+    return _cached_response(entry)
 
 
 @app.route('/broadcasts/debug', strict_slashes=False)
 def debug_broadcasts():
     if not (BROADCAST_CLIENT_ID and BROADCAST_CLIENT_SECRET and BROADCAST_REFRESH_TOKEN):
         return jsonify({})
-    yb = YoutubeBroadcasts(BROADCAST_CLIENT_ID, BROADCAST_CLIENT_SECRET, BROADCAST_REFRESH_TOKEN)
+    yb = _youtube_client('wdwnt', BROADCAST_CLIENT_ID, BROADCAST_CLIENT_SECRET, BROADCAST_REFRESH_TOKEN)
     response_dict = yb.get_broadcasts(show_unlisted=True, debug=True)
     return jsonify(response_dict)
 
@@ -468,16 +1020,26 @@ def podcasts():
     with_player = 'noplayer' not in request.args
     url = 'https://podcasts.wdwnt.com/wp-json/wp/v2/posts?per_page={}&page={}&_embed'
     url = url.format(in_per_page, in_page)
+    # print(url)
+
+    def fetch():
+        response = _upstream_get(url, url, headers=WP_HEADER)
+        return format_wp(response.json(), with_content=True, with_player=True)
+
+    if with_content and with_player:
+        entry = _cached_fetch(url, fetch)
+        return _cached_response(entry)
+
     cache_url = '{}|{}|{}'.format('WithContent' if with_content else 'NoContent',
                                   'WithPlayer' if with_player else 'NoPlayer', url)
-    # TODO - use cache data with content/player to populate NoContent/NoPlayer
-    # print(url)
-    response_dict = _get_from_cache(cache_url)
-    if not response_dict:
-        response = requests.get(url, headers=WP_HEADER)
-        response_dict = format_wp(response.json(), with_content=with_content, with_player=with_player)
-        _store_in_cache(cache_url, response_dict)
-    return jsonify(response_dict)
+
+    def project():
+        canonical = _cached_fetch(url, fetch)
+        response_list = _project_podcast_posts(_entry_data(canonical), with_content, with_player)
+        return _store_projection(cache_url, response_list, canonical)
+
+    entry = _cached_fetch(cache_url, project, store=False)
+    return _cached_response(entry)
 
 
 @app.route('/podcasts/<int:post_id>')
@@ -487,13 +1049,25 @@ def single_podcast(post_id):
     url = url.format(post_id)
     # print(url)
     with_player = 'noplayer' not in request.args
-    cache_url = '{}|{}'.format('WithPlayer' if with_player else 'NoPlayer', url)
-    response_dict = _get_from_cache(cache_url)
-    if not response_dict:
-        response = requests.get(url, headers=WP_HEADER)
-        response_dict = format_wp_single_post(response.json(), with_player=with_player)
-        _store_in_cache(cache_url, response_dict)
-    return jsonify(response_dict)
+
+    def fetch():
+        response = _upstream_get(url, url, headers=WP_HEADER)
+        return format_wp_single_post(response.json(), with_player=True)
+
+    if with_player:
+        entry = _cached_fetch(url, fetch)
+        return _cached_response(entry)
+
+    cache_url = 'NoPlayer|{}'.format(url)
+
+    def project():
+        canonical = _cached_fetch(url, fetch)
+        response_dict = _entry_data(canonical)
+        response_dict['text'], response_dict['media_url'] = remove_player(response_dict['text'])
+        return _store_projection(cache_url, response_dict, canonical)
+
+    entry = _cached_fetch(cache_url, project, store=False)
+    return _cached_response(entry)
 
 
 # Blog posts, pages, and utilities
@@ -513,20 +1087,124 @@ def posts():
         url = 'https://wdwnt.com/wp-json/wp/v2/posts?categories={}&per_page={}&page={}&_embed'
         url = url.format(in_categories, in_per_page, in_page)
     elif in_search:
+        if search_index is not None:
+            try:
+                results = search_index.search(in_search, int(in_per_page), int(in_page))
+            except ValueError:
+                results = None
+            if results is not None:
+                return _cached_response(_make_entry(results, compress=False))
         url = 'https://wdwnt.com/wp-json/wp/v2/posts?search={}&per_page={}&page={}&_embed'
+        if search_index is not None:
+            # In the order of the local results, so that every page of a
+            # query lines up whichever side answers it.
+            url = url.replace('&_embed', '&orderby=date&_embed')
         url = url.format(in_search, in_per_page, in_page)
         add_to_cache = False
     else:
         url = 'https://wdwnt.com/wp-json/wp/v2/posts?per_page={}&page={}&_embed'
         url = url.format(in_per_page, in_page)
     # print(url)
-    response_dict = _get_from_cache(url)
-    if not response_dict:
-        response = requests.get(url, headers=WP_HEADER)
-        response_dict = format_wp(response.json())
-        if add_to_cache:
-            _store_in_cache(url, response_dict)
-    return jsonify(response_dict)
+
+    fields = WP_ENTITY_FIELDS
+    if search_index is not None and not (in_slug or in_categories or in_search):
+        fields = tuple(dict.fromkeys(WP_ENTITY_FIELDS + WP_SEARCH_FIELDS))
+
+    def fetch():
+        data, status_code = _wp_get_list(url, 'posts', slug=in_slug, fields=fields)
+        if not add_to_cache:
+            return _make_entry(format_wp(data), compress=False)
+        if search_index is not None and not (in_slug or in_categories) and status_code < 400 and \
+                isinstance(data, list) and data:
+            try:
+                search_index.add_page(int(in_page), int(in_per_page), min(x.get('date_gmt') or '' for x in data))
+            except ValueError:
+                pass
+        return _store_in_cache(url, format_wp(data),
+                               tags=_list_tags('posts', data, in_categories))
+
+    if add_to_cache:
+        entry = _cached_fetch(url, fetch, store=False)
+    else:
+        entry = fetch()
+    return _cached_response(entry)
+
+
+def _wp_gmt_offset():
+    # Hours WordPress local time is ahead of UTC, from the /wp-json root.
+    # Checked hourly to follow daylight saving changes.
+    now = datetime.now(timezone.utc).timestamp()
+    if now - wp_gmt_offset['checked_at'] > 3600:
+        try:
+            response = http_client.get('https://wdwnt.com/wp-json?_fields=gmt_offset', headers=WP_HEADER)
+            hours = float(response.json()['gmt_offset'])
+        except Exception as e:
+            print('Could not read the WordPress GMT offset: {}'.format(e))
+            hours = None
+        wp_gmt_offset.update(hours=hours, checked_at=now)
+    return wp_gmt_offset['hours']
+
+
+def _sync_posts():
+    # Adds the posts modified since the last check, or in the last
+    # SYNC_WINDOW_SECONDS on the first one, to change_index, newest first.
+    # When there are more than SYNC_MAX_PAGES pages of them only the
+    # fetched ones are known and the index starts over from the oldest.
+    if change_index.complete_since is None:
+        start = datetime.utcnow() - timedelta(seconds=SYNC_WINDOW_SECONDS)
+    else:
+        start = datetime.utcfromtimestamp(change_index.checked_at)
+    # WordPress compares modified_after with its local time.  Without the
+    # offset assume the earliest timezone.
+    hours = _wp_gmt_offset()
+    modified = start + timedelta(hours=hours if hours is not None else -12, seconds=-SYNC_OVERLAP_SECONDS)
+    url = ('https://wdwnt.com/wp-json/wp/v2/posts?modified_after={}&orderby=modified&order=desc'
+           '&per_page=100&page={}&_embed')
+    oldest = None
+    for page in range(1, SYNC_MAX_PAGES + 1):
+        posts, status_code = _wp_get(url.format(modified.strftime('%Y-%m-%dT%H:%M:%S'), page), WP_LIST_FIELDS)
+        if status_code >= 500 or (status_code < 400 and not isinstance(posts, list)):
+            return
+        if status_code >= 400:
+            break
+        changed = [x for x in posts if isinstance(x, dict) and 'id' in x and x.get('modified_gmt')]
+        _index_posts(changed)
+        if changed:
+            oldest = changed[-1]['modified_gmt']
+        if len(posts) < 100:
+            break
+    else:
+        if oldest is not None:
+            change_index.mark_complete((oldest, ChangeIndex.MAX_ID), replace=True)
+        return
+    change_index.mark_complete((start.strftime('%Y-%m-%dT%H:%M:%S'), 0))
+
+
+@app.route('/posts/sync')
+def posts_sync():
+    in_cursor = request.args.get('cursor', '')
+    try:
+        in_per_page = max(1, min(int(request.args.get('per_page', POSTS_PER_PAGE)), 100))
+        since = parse_cursor(in_cursor) if in_cursor else None
+    except ValueError:
+        return jsonify({'status': 'Invalid cursor'}), 400
+    if since is None:
+        # Clients start syncing from now.
+        return jsonify({'posts': [], 'cursor': make_cursor(datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'))})
+
+    # WordPress is only asked for what changed since the last check, never
+    # per cursor.
+    if not change_index.fresh(SYNC_EXPIRE_SECONDS):
+        single_flight.do('sync', _sync_posts)
+    if change_index.complete_since is None:
+        return jsonify({'status': 'Sync unavailable'}), 503
+    if since < change_index.complete_since:
+        # Older than what this worker indexes, the client has to reload.
+        return jsonify({'status': 'Cursor expired'}), 410
+
+    changes = change_index.changes(since, in_per_page)
+    cursor = make_cursor(*changes[-1][0]) if changes else in_cursor
+    return jsonify({'posts': [item for _, item in changes], 'cursor': cursor})
 
 
 @app.route('/cpt/<cpt_type>', strict_slashes=False)
@@ -541,17 +1219,23 @@ def cpt(cpt_type, cpt_id=None):
     else:
         url = f'https://wdwnt.com/wp-json/wp/v2/{cpt_type}?per_page={in_per_page}&page={in_page}&_embed'
 
-    response_dict = _get_from_cache(url)
-    if not response_dict:
-        response = requests.get(url, headers=WP_HEADER)
-        if response.status_code == 404:
-            response_dict = {}
+    def fetch():
+        if cpt_id:
+            data, status_code = _wp_get_single(url, cpt_type, cpt_id)
+            tags = _wp_tags(cpt_type, data, '{}:{}'.format(cpt_type, cpt_id))
+        else:
+            data, status_code = _wp_get_list(url, cpt_type)
+            tags = _list_tags(cpt_type, data)
+        if status_code == 404:
+            result = {}
         elif cpt_id:
-            response_dict = format_wp_single_post(response.json())
+            result = format_wp_single_post(data)
         else:
-            response_dict = format_wp(response.json())
-        _store_in_cache(url, response_dict)
-    return jsonify(response_dict)
+            result = format_wp(data)
+        return _store_in_cache(url, result, tags=tags)
+
+    entry = _cached_fetch(url, fetch, store=False)
+    return _cached_response(entry)
 
 
 @app.route('/posts/<int:post_id>')
@@ -560,12 +1244,14 @@ def single_post(post_id):
     url = 'https://wdwnt.com/wp-json/wp/v2/posts/{}?_embed'
     url = url.format(post_id)
     # print(url)
-    response_dict = _get_from_cache(url)
-    if not response_dict:
-        response = requests.get(url, headers=WP_HEADER)
-        response_dict = format_wp_single_post(response.json())
-        _store_in_cache(url, response_dict)
-    return jsonify(response_dict)
+
+    def fetch():
+        data, _ = _wp_get_single(url, 'posts', post_id)
+        return _store_in_cache(url, format_wp_single_post(data),
+                               tags=_wp_tags('posts', data, 'posts:{}'.format(post_id)))
+
+    entry = _cached_fetch(url, fetch, store=False)
+    return _cached_response(entry)
 
 
 @app.route('/pages', strict_slashes=False)
@@ -580,12 +1266,13 @@ def pages():
         url = 'https://wdwnt.com/wp-json/wp/v2/pages?per_page={}&page={}&_embed'
         url = url.format(in_per_page, in_page)
     # print(url)
-    response_dict = _get_from_cache(url)
-    if not response_dict:
-        response = requests.get(url, headers=WP_HEADER)
-        response_dict = format_wp(response.json())
-        _store_in_cache(url, response_dict)
-    return jsonify(response_dict)
+
+    def fetch():
+        data, _ = _wp_get_list(url, 'pages', slug=in_slug)
+        return _store_in_cache(url, format_wp(data), tags=_list_tags('pages', data))
+
+    entry = _cached_fetch(url, fetch, store=False)
+    return _cached_response(entry)
 
 
 @app.route('/pages/<int:post_id>')
@@ -594,12 +1281,14 @@ def single_page(post_id):
     url = 'https://wdwnt.com/wp-json/wp/v2/pages/{}?_embed'
     url = url.format(post_id)
     # print(url)
-    response_dict = _get_from_cache(url)
-    if not response_dict:
-        response = requests.get(url, headers=WP_HEADER)
-        response_dict = format_wp_single_post(response.json())
-        _store_in_cache(url, response_dict)
-    return jsonify(response_dict)
+
+    def fetch():
+        data, _ = _wp_get_single(url, 'pages', post_id)
+        return _store_in_cache(url, format_wp_single_post(data),
+                               tags=_wp_tags('pages', data, 'pages:{}'.format(post_id)))
+
+    entry = _cached_fetch(url, fetch, store=False)
+    return _cached_response(entry)
 
 
 @app.route('/announcements', strict_slashes=False)
@@ -607,16 +1296,19 @@ def announcements():
     # url = 'https://wdwnt.com/wp-json/wp/v2/announcements?appflag=7566,7568'
     # https://wdwnt.com/wp-json/wp/v2/appflag?include=7566,7568
     url = 'https://wdwnt.com/wp-json/wp/v2/announcements?_embed'
-    response_dict = _get_from_cache(url)
-    if not response_dict:
-        response = requests.get(url, headers=WP_HEADER)
+
+    def fetch():
+        response = _upstream_get(url, url, headers=WP_HEADER)
+        posts = [x for x in response.json() if x['appflag'][0] in WP_APPFLAGS]
+        formatted = _format_all(format_wp_single_post, posts, with_icon=True)
         response_dict = {}
         for a_id, slug in WP_APPFLAGS.items():
-            response_dict[slug] = [format_wp_single_post(x, with_icon=True)
-                                   for x in response.json()
+            response_dict[slug] = [obj for x, obj in zip(posts, formatted)
                                    if x['appflag'][0] == a_id]
-        _store_in_cache(url, response_dict)
-    return jsonify(response_dict)
+        return response_dict
+
+    entry = _cached_fetch(url, fetch)
+    return _cached_response(entry)
 
 
 @app.route('/notifications', strict_slashes=False)
@@ -625,12 +1317,13 @@ def notifications():
     in_page = request.args.get('page', 1)
     url = 'https://wdwnt.com/wp-json/wp/v2/app_notification?per_page={}&page={}'
     url = url.format(in_per_page, in_page)
-    response_dict = _get_from_cache(url)
-    if not response_dict:
-        response = requests.get(url, headers=WP_HEADER)
-        response_dict = format_notifications(response.json())
-        _store_in_cache(url, response_dict)
-    return jsonify(response_dict)
+
+    def fetch():
+        data, _ = _wp_get(url, WP_NOTIFICATION_FIELDS, embed=(), key=url)
+        return format_notifications(data)
+
+    entry = _cached_fetch(url, fetch)
+    return _cached_response(entry)
 
 # Instagram via RSSHub
 
@@ -638,34 +1331,33 @@ def notifications():
 def instagram(username):
     url = 'https://rsshub.app/picuki/profile/{}'
     url = url.format(username)
-    response_string = _get_from_cache(url)
-    if not response_string:
-        response = requests.get(url)
-        response_string = response.text
-        _store_in_cache(url, response_string, expire_seconds=INSTAGRAM_EXPIRE_SECONDS)
-    return response_string
+
+    def fetch():
+        response = _upstream_get(url, url)
+        return response.text
+
+    entry = _cached_fetch(url, fetch, expire_seconds=INSTAGRAM_EXPIRE_SECONDS)
+    return _cached_response(entry)
 
 # Live365
 
-@app.route('/live365')
-def live365():
+def _live365_entry():
     url = 'https://api.live365.com/station/a31769'
-    response_dict = _get_from_cache(url)
-    if not response_dict:
-        response = requests.get(url, timeout=TIMEOUT_SECONDS)
+
+    def fetch():
+        response = http_client.get(url)
         try:
             response.raise_for_status()
             response_dict = format_live365(response.json())
         except requests.exceptions.HTTPError:
-            err_resp = _get_error_json(request.path)
-            _store_in_cache(url, err_resp, expire_seconds=LIVE365_EXPIRE_SECONDS)
-            return jsonify(err_resp)
+            err_resp = _get_error_json('/live365')
+            return _store_in_cache(url, err_resp, expire_seconds=LIVE365_EXPIRE_SECONDS, stale_seconds=0)
         calc_end_time = datetime.utcnow() + timedelta(seconds=LIVE365_EXPIRE_SECONDS)
         calc_end_time = calc_end_time.replace(tzinfo=timezone.utc)
         if response_dict['live_dj_on']:
             response_dict['current-track']['end'] = calc_end_time.isoformat()
             response_dict['current-track']['duration'] = str(timedelta(seconds=LIVE365_EXPIRE_SECONDS))
-            _store_in_cache(url, response_dict)
+            return _store_in_cache(url, response_dict, stale_seconds=0)
         else:
             if response_dict['current-track'].get('end') is None:
                 ending = calc_end_time
@@ -678,8 +1370,88 @@ def live365():
                     ending = calc_end_time
                     # Replace ending so that it checks more frequently.
                     response_dict['current-track']['end'] = calc_end_time.isoformat()
-            _store_in_cache(url, response_dict, expire_time=ending)
-    return jsonify(response_dict)
+            return _store_in_cache(url, response_dict, expire_time=ending, stale_seconds=0)
+
+    return _cached_fetch(url, fetch, store=False)
+
+
+@app.route('/live365')
+def live365():
+    return _cached_response(_live365_entry())
+
+
+def _event_sources():
+    sources = {'live365': _live365_entry}
+    for site_code, client_id, client_secret, refresh_token in (
+            ('wdwnt', BROADCAST_CLIENT_ID, BROADCAST_CLIENT_SECRET, BROADCAST_REFRESH_TOKEN),
+            ('upnt', BROADCAST_UPNT_CLIENT_ID, BROADCAST_UPNT_CLIENT_SECRET, BROADCAST_UPNT_REFRESH_TOKEN),
+            ('entertainment', BROADCAST_ENTERTAINMENT_CLIENT_ID, BROADCAST_ENTERTAINMENT_CLIENT_SECRET,
+             BROADCAST_ENTERTAINMENT_REFRESH_TOKEN)):
+        if client_id and client_secret and refresh_token:
+            sources[f'{site_code}/broadcasts'] = partial(_broadcasts_entry, site_code, client_id,
+                                                         client_secret, refresh_token)
+    return sources
+
+
+event_hub = EventHub(_event_sources(), min_interval=EVENTS_MIN_INTERVAL_SECONDS,
+                     heartbeat_seconds=EVENTS_HEARTBEAT_SECONDS, max_clients=EVENTS_MAX_CLIENTS)
+
+
+@app.route('/events')
+def events():
+    # Server-Sent Events: the body of /live365 and /<site>/broadcasts each
+    # time it changes, as events named live365 and <site>/broadcasts.
+    # Streams stay open, which only gevent workers can afford.
+    if WORKER_CLASS != 'gevent':
+        return jsonify({'status': 'Events need FASTPASS_WORKER_CLASS=gevent'}), 503
+    topics = [x for x in request.args.get('topics', '').split(',') if x] or list(event_hub.sources)
+    if not all(x in event_hub.sources for x in topics):
+        return jsonify({'status': 'Invalid topics', 'topics': list(event_hub.sources)}), 400
+    subscriber = event_hub.subscribe(set(topics))
+    if subscriber is None:
+        return jsonify({'status': 'Too many clients'}), 503
+    response = Response(event_hub.stream(subscriber), mimetype='text/event-stream')
+    response.cache_control.no_cache = True
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def _batch_item(path):
+    # Runs the route for path as its own request and returns the response
+    # body as JSON bytes.
+    try:
+        with app.test_request_context(path):
+            response = app.full_dispatch_request()
+            status, body = response.status_code, response.get_data()
+            if response.mimetype != 'application/json':
+                body = json.dumps(body.decode('utf-8')).encode('utf-8')
+            elif not body.strip():
+                body = b'null'
+    except Exception as e:
+        print('Batch request for {} failed: {}'.format(path, e))
+        status, body = 500, b'null'
+    return b'{"data":' + body.rstrip() + b',"status":' + str(status).encode('utf-8') + b'}'
+
+
+@app.route('/batch', methods=['GET', 'POST'])
+def batch():
+    # GET /batch?path=/posts&path=/live365 or POST {"paths": [...]}.  The
+    # paths run concurrently, on threads of this request so that batches of
+    # other clients never wait behind its misses, and their bodies are
+    # copied into one document keyed by path without decoding them.
+    if request.method == 'POST':
+        paths = (request.get_json(silent=True) or {}).get('paths', [])
+    else:
+        paths = request.args.getlist('path')
+    if not isinstance(paths, list) or not paths or len(paths) > BATCH_MAX_PATHS or \
+            not all(isinstance(x, str) and x.startswith('/') and not x.startswith(('/batch', '/events')) for x in paths):
+        return jsonify({'status': 'Invalid paths'}), 400
+    paths = list(dict.fromkeys(paths))
+    with ThreadPoolExecutor(max_workers=min(BATCH_WORKERS, len(paths))) as executor:
+        results = list(executor.map(_batch_item, paths))
+    body = b','.join(json.dumps(path).encode('utf-8') + b':' + result
+                     for path, result in zip(paths, results))
+    return Response(b'{' + body + b'}\n', mimetype='application/json')
 
 
 @app.route('/ntunes')
@@ -712,6 +1484,20 @@ def clear_posts():
     return ('', 204) if resp else (jsonify({'status': 'Invalid status'}), 401)
 
 
+@app.route('/purge', methods=['POST'])
+def purge():
+    data = request.json
+    if not isinstance(data, dict):
+        data = {}
+    try:
+        purged = _purge(data.get('status'), data)
+    except ValueError:
+        return jsonify({'status': 'Invalid purge request'}), 400
+    if purged is None:
+        return jsonify({'status': 'Invalid status'}), 401
+    return jsonify({'purged': purged})
+
+
 @app.route('/settings')
 def settings_call():
     if GIT_COMMIT:
@@ -724,7 +1510,12 @@ def settings_call():
         'version': ver,
         'description': GIT_DESCRIPTION,
         'deployed_at': GIT_RELEASE_AT,
-        'mem_cache': mem_cache
+        'mem_cache': {k: {'data': _entry_data(v) if 'body' in v else v.get('post', v), 'expire_at': v['expire_at']}
+                      for k, v in cache.snapshot().items()},
+        'cache_stats': cache.stats(),
+        'search_index': search_index.stats() if search_index is not None else None,
+        'slack_queue': slack_queue.stats() if slack_queue is not None else None,
+        'events': event_hub.stats()
     })
 
 
@@ -1,7 +1,53 @@
+import json
+import threading
+import time
 import unittest
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+from datetime import datetime, timedelta, timezone
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from flask import Response
 
 import fastpass
+from cache import JsonCodec, MemoryCache, RedisCache, msgpack, get_codec
+from events import EventHub
+from powerpress import remove_player, remove_player_soup
+from search import SearchIndex
+from singleflight import SingleFlight
+from slack import SlackQueue
+from sync import ChangeIndex, parse_cursor
+from warmer import CacheWarmer
+from youtube import YoutubeBroadcasts
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, data=None, headers=None):
+        self.status_code = status_code
+        self.data = data
+        self.content = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.headers = headers or {}
+
+    def json(self):
+        if self.data is None:
+            raise ValueError('No JSON')
+        return self.data
+
+
+class FakeClient(object):
+    """Stands in for http_client, answering with respond(url, headers)."""
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.urls = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.urls.append(url)
+        return self.respond(url, headers or {})
 
 
 class TestFunctions(unittest.TestCase):
@@ -31,5 +77,625 @@ class TestFunctions(unittest.TestCase):
                 self.assertGreater(t1, t2, 'Cached for {}'.format(func))
 
 
+class TestRevalidation(unittest.TestCase):
+    def test_not_modified_keeps_entry(self):
+        class Response(object):
+            def __init__(self, status_code, text=''):
+                self.status_code = status_code
+                self.text = text
+                self.content = text.encode('utf-8')
+                self.headers = {'ETag': '"v1"'}
+
+        class Client(object):
+            def __init__(self):
+                self.headers = []
+
+            def get(self, url, headers=None, **kwargs):
+                self.headers.append(headers or {})
+                return Response(304) if headers else Response(200, '<rss/>')
+
+        client, http_client = Client(), fastpass.http_client
+        fastpass.http_client = client
+        url = 'https://rsshub.app/picuki/profile/test'
+
+        def fetch():
+            return fastpass._upstream_get(url, url).text
+
+        try:
+            fastpass._cached_fetch(url, fetch, expire_seconds=0)
+            time.sleep(0.01)
+            refreshed = fastpass._cached_fetch(url, fetch, expire_seconds=60)
+        finally:
+            fastpass.http_client = http_client
+            fastpass.cache.delete(url)
+        self.assertEqual(client.headers[-1], {'If-None-Match': '"v1"'})
+        self.assertEqual(refreshed['body'], b'<rss/>')
+        self.assertGreater(refreshed['expire_at'], time.time())
+
+
+class TestWpProjection(unittest.TestCase):
+    POST = {'id': 1, '_links': {'author': [{'href': 'x'}]}, '_embedded': {'author': [{'name': 'Tom'}]}}
+
+    def setUp(self):
+        self.http_client = fastpass.http_client
+        self.unsupported = set(fastpass.wp_projection_unsupported)
+
+    def tearDown(self):
+        fastpass.http_client = self.http_client
+        fastpass.wp_projection_unsupported.clear()
+        fastpass.wp_projection_unsupported.update(self.unsupported)
+
+    def get(self, host, projected, full=FakeResponse(200, [POST])):
+        # Answers the projected url with projected and the full url with full.
+        client = fastpass.http_client = FakeClient(lambda url, headers: projected if '_fields=' in url else full)
+        result = fastpass._wp_get('https://{}/wp-json/wp/v2/posts?per_page=1&_embed'.format(host),
+                                  fastpass.WP_LIST_FIELDS)
+        return result, client.urls
+
+    def test_projection_used(self):
+        (data, status_code), urls = self.get('ok.test', FakeResponse(200, [self.POST]))
+        self.assertEqual((data, status_code, len(urls)), ([self.POST], 200, 1))
+        self.assertIn('_embed=author,wp:featuredmedia,wp:term&_fields=id,slug', urls[0])
+        self.assertNotIn('ok.test', fastpass.wp_projection_unsupported)
+
+    def test_not_found_passed_through(self):
+        (data, status_code), urls = self.get('missing.test', FakeResponse(404, {'code': 'rest_no_route'}))
+        self.assertEqual((data, status_code, len(urls)), ({'code': 'rest_no_route'}, 404, 1))
+        self.assertNotIn('missing.test', fastpass.wp_projection_unsupported)
+
+    def test_failed_projection_falls_back(self):
+        for host, projected in (('error.test', FakeResponse(400, {'code': 'rest_invalid_param'})),
+                                ('html.test', FakeResponse(200)),
+                                ('unembedded.test', FakeResponse(200, [{'id': 1, '_links': {'author': [{}]}}]))):
+            (data, status_code), urls = self.get(host, projected)
+            self.assertEqual((data, status_code), ([self.POST], 200), host)
+            self.assertEqual(urls[1], 'https://{}/wp-json/wp/v2/posts?per_page=1&_embed'.format(host))
+            self.assertIn(host, fastpass.wp_projection_unsupported)
+        # Unsupported hosts get the full url straight away.
+        self.assertEqual(len(self.get('error.test', FakeResponse(200, [self.POST]))[1]), 1)
+
+    def test_host_kept_when_full_url_fails_too(self):
+        (data, status_code), urls = self.get('down.test', FakeResponse(503, {}), FakeResponse(503, {}))
+        self.assertEqual((status_code, len(urls)), (503, 2))
+        self.assertNotIn('down.test', fastpass.wp_projection_unsupported)
+
+
+class TestEntityStore(unittest.TestCase):
+    URL = 'https://wdwnt.com/wp-json/wp/v2/posts?per_page=1&page=1&_embed'
+    POST = {'id': 3, 'slug': 'three', 'guid': {'rendered': 'https://wdwnt.com/?p=3'},
+            'title': {'rendered': 'Three'}, 'date_gmt': '2020-01-01T00:00:00',
+            'modified_gmt': '2020-01-01T00:00:00', 'content': {'rendered': '<p>Three</p>'}, '_links': {}}
+
+    def setUp(self):
+        self.cache, self.http_client = fastpass.cache, fastpass.http_client
+        fastpass.cache = MemoryCache(sweep_seconds=0)
+
+    def tearDown(self):
+        fastpass.cache, fastpass.http_client = self.cache, self.http_client
+
+    def test_records_kept_while_list_is_not_modified(self):
+        def respond(url, headers):
+            if 'If-None-Match' in headers:
+                return FakeResponse(304)
+            return FakeResponse(200, [self.POST], {'ETag': '"v1"'})
+
+        client = fastpass.http_client = FakeClient(respond)
+
+        def fetch():
+            data, _ = fastpass._wp_get_list(self.URL, 'posts', expire_seconds=1)
+            return fastpass._store_in_cache(self.URL, fastpass.format_wp(data), expire_seconds=1)
+
+        fastpass._cached_fetch(self.URL, fetch, store=False, expire_seconds=1)
+        time.sleep(1.1)
+        self.assertIsNone(fastpass._get_entity(self.URL, 'posts', 3, fastpass.WP_LIST_FIELDS))
+        fastpass._cached_fetch(self.URL, fetch, store=False, expire_seconds=1)
+        self.assertEqual(len(client.urls), 2)
+        self.assertEqual(fastpass._get_entity(self.URL, 'posts', 3, fastpass.WP_LIST_FIELDS)['id'], 3)
+        slug_url = 'https://wdwnt.com/wp-json/wp/v2/posts?slug=three&_embed'
+        self.assertEqual(fastpass._wp_get_list(slug_url, 'posts', slug='three')[0][0]['id'], 3)
+        self.assertEqual(len(client.urls), 2)
+
+    def test_single_post_from_list(self):
+        post = dict(self.POST, acf={'app_menu_icon': 'star', 'other': 'x' * 100},
+                    _links={'author': [{'href': 'https://wdwnt.com/wp-json/wp/v2/users/1'}]},
+                    _embedded={'author': [{'id': 1, 'name': 'Tom', 'description': 'Writer', 'link': 'x',
+                                           'avatar_urls': {'24': 'a24', '96': 'a96'}}],
+                               'wp:featuredmedia': [{'source_url': 'image.jpg', 'media_details': {'x': 1}}],
+                               'wp:term': [[{'name': 'News', 'taxonomy': 'category'}], [{'name': 'Tag'}]]})
+        post['jetpack-related-posts'] = [{'id': 4, 'title': 'Four', 'img': {'src': 'four.jpg'}, 'url': 'x'}]
+        client = fastpass.http_client = FakeClient(lambda url, headers: FakeResponse(200, [post]))
+        fields = tuple(dict.fromkeys(fastpass.WP_LIST_FIELDS + fastpass.WP_SINGLE_FIELDS))
+        fastpass._wp_get_list(self.URL, 'posts', fields=fields)
+        record = fastpass.cache.get(fastpass._entity_key(self.URL, 'posts', 3))['post']
+        self.assertNotIn('_links', record)
+        self.assertEqual(record['acf'], {'app_menu_icon': 'star'})
+        response = fastpass.app.test_client().get('/posts/3')
+        self.assertEqual(response.get_json(), fastpass.format_wp_single_post(post))
+        self.assertEqual(fastpass.format_wp([record]), fastpass.format_wp([post]))
+        self.assertEqual(len(client.urls), 1)
+
+    def test_single_post_needs_single_fields(self):
+        client = fastpass.http_client = FakeClient(lambda url, headers: FakeResponse(200, [self.POST]))
+        fastpass._wp_get_list(self.URL, 'posts', fields=fastpass.WP_LIST_FIELDS)
+        self.assertIsNone(fastpass._get_entity(self.URL, 'posts', 3, fastpass.WP_SINGLE_FIELDS))
+        client.respond = lambda url, headers: FakeResponse(200, self.POST)
+        self.assertEqual(fastpass.app.test_client().get('/posts/3').get_json()['text'], '<p>Three</p>')
+        self.assertEqual(len(client.urls), 2)
+        self.assertIn('/posts/3?_embed=', client.urls[1])
+        self.assertIn('jetpack-related-posts', client.urls[1])
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_followers_share_leader_result(self):
+        single_flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def func():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'value'
+
+        leader = threading.Thread(target=lambda: results.append(single_flight.do('key', func)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(single_flight.do('key', func)))
+                     for _ in range(3)]
+        for thread in followers:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+        self.assertEqual((len(calls), results), (1, ['value'] * 4))
+
+    def test_error_reaches_waiters(self):
+        single_flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        errors = []
+
+        def func():
+            started.set()
+            release.wait(5)
+            raise ValueError('upstream failed')
+
+        def call():
+            try:
+                single_flight.do('key', func)
+            except ValueError as e:
+                errors.append(str(e))
+
+        threads = [threading.Thread(target=call)]
+        threads[0].start()
+        started.wait(5)
+        threads.append(threading.Thread(target=call))
+        threads[1].start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(errors, ['upstream failed'] * 2)
+        self.assertEqual(single_flight.do('key', lambda: 'retried'), 'retried')
+
+    def test_recheck_skips_func(self):
+        single_flight = SingleFlight()
+        calls = []
+        self.assertEqual(single_flight.do('key', lambda: calls.append(1), recheck=lambda: 'cached'), 'cached')
+        self.assertEqual(single_flight.do('key', lambda: 'fresh', recheck=lambda: None), 'fresh')
+        self.assertEqual(calls, [])
+
+
+class TestStaleWhileRevalidate(unittest.TestCase):
+    def test_stale_entry_served_while_refreshing(self):
+        key = 'test|stale'
+        now = time.time()
+        stale = fastpass._make_entry('old', now - 1, now + 60)
+        fastpass.cache.set(key, stale, stale['stale_until'])
+        refreshed = threading.Event()
+
+        def fetch():
+            refreshed.set()
+            return 'new'
+
+        try:
+            self.assertEqual(fastpass._cached_fetch(key, fetch, expire_seconds=60)['body'], b'old')
+            self.assertTrue(refreshed.wait(5))
+            for _ in range(50):
+                if key not in fastpass.refreshing_keys:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(fastpass._cached_fetch(key, fetch)['body'], b'new')
+            # Past stale_until the caller waits for a fresh entry.
+            gone = fastpass._make_entry('old', now - 2, now - 1)
+            fastpass.cache.set(key, gone, now + 60)
+            self.assertEqual(fastpass._cached_fetch(key, lambda: 'newest')['body'], b'newest')
+        finally:
+            fastpass.cache.delete(key)
+
+
+class TestCacheWarmer(unittest.TestCase):
+    def wait_idle(self, warmer):
+        for _ in range(100):
+            if not warmer._in_flight:
+                return
+            time.sleep(0.01)
+
+    def test_run_once(self):
+        now = time.time()
+        expiries = {'k1': now + 5, 'k2': now + 100, 'k3': now + 25}
+        release, warmed = threading.Event(), []
+
+        def warm(path):
+            warmed.append(path)
+            release.wait(5)
+
+        warmer = CacheWarmer(warm, expiries.get, paths=['/a'], top_n=4, lead_seconds=10, jitter_seconds=20,
+                             concurrency=4)
+        warmer.record('/a', 'k1')
+        for path, key in (('/b', 'k2'), ('/b', 'k2'), ('/c', 'k3'), ('/d', 'k4')):
+            warmer.record(path, key)
+        with mock.patch('warmer.random.uniform', return_value=0):
+            warmer.run_once()
+            # Still being warmed.
+            warmer.run_once()
+        release.set()
+        self.wait_idle(warmer)
+        self.assertEqual(sorted(warmed), ['/a', '/d'])
+        with mock.patch('warmer.random.uniform', return_value=20):
+            warmer.run_once()
+        self.wait_idle(warmer)
+        self.assertEqual(sorted(warmed), ['/a', '/a', '/c', '/d', '/d'])
+
+    def test_refresh_skips_entry_refreshed_elsewhere(self):
+        key = 'test|warm'
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return 'new'
+
+        try:
+            for expire_seconds, fetched in ((600, 0), (1, 1)):
+                now = time.time()
+                entry = fastpass._make_entry('old', now + expire_seconds, now + expire_seconds)
+                fastpass.cache.set(key, entry, entry['stale_until'])
+                with fastpass.app.test_request_context('/warm'):
+                    fastpass.g.fastpass_refresh = True
+                    fastpass._cached_fetch(key, fetch)
+                self.assertEqual(len(calls), fetched)
+        finally:
+            fastpass.cache.delete(key)
+
+
+class TestMemoryCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = MemoryCache(max_entries=2)
+        expire_at = time.time() + 60
+        cache.set('a', {'data': 1}, expire_at)
+        cache.set('b', {'data': 2}, expire_at)
+        cache.get('a')
+        cache.set('c', {'data': 3}, expire_at)
+        self.assertEqual(sorted(cache.keys()), ['a', 'c'])
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_byte_budget_and_sweep(self):
+        cache = MemoryCache(max_bytes=1000, sweep_seconds=0)
+        cache.set('big', {'data': 'x' * 2000}, time.time() + 60)
+        self.assertIsNone(cache.get('big'))
+        cache.set('old', {'data': 1}, time.time() - 1)
+        cache.set('new', {'data': 2}, time.time() + 60)
+        self.assertEqual(cache.keys(), ['new'])
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_purge_tags(self):
+        cache = MemoryCache()
+        expire_at = time.time() + 60
+        cache.set('list', {'data': 1}, expire_at, tags=['posts:list', 'posts:1', 'posts:2'])
+        cache.set('single', {'data': 2}, expire_at, tags=['posts:2'])
+        cache.set('other', {'data': 3}, expire_at, tags=['posts:3'])
+        self.assertEqual(cache.purge_tags(['posts:2']), 2)
+        self.assertEqual(cache.keys(), ['other'])
+        cache.set('other', {'data': 4}, expire_at)
+        self.assertEqual(cache.purge_tags(['posts:3']), 0)
+
+
+class TestRedisCacheCodecs(unittest.TestCase):
+    def test_pack_roundtrip(self):
+        values = [b'\x00raw bytes', {'data': [1, 'two', None], 'text': 'x' * 200}, 'plain', 3.5]
+        codecs = [JsonCodec()] + ([get_codec('msgpack')] if msgpack is not None else [])
+        for codec in codecs:
+            for compress_min_bytes in (0, 16):
+                cache = RedisCache(None, codec=codec, compress_min_bytes=compress_min_bytes)
+                for value in values:
+                    packed = cache._pack(value)
+                    self.assertEqual(cache._unpack(packed), value)
+        cache = RedisCache(None, compress_min_bytes=16)
+        self.assertEqual(cache._pack(b'short')[:1], RedisCache.RAW)
+        self.assertEqual(cache._pack(b'x' * 100)[:1], RedisCache.RAW.upper())
+        self.assertEqual(cache._pack({'a': 'x' * 100})[:1], RedisCache.CODEC.upper())
+        self.assertRaises(NotImplementedError, get_codec, 'pickle')
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class TestRedisCacheTags(unittest.TestCase):
+    def test_expired_keys_leave_tag_sets(self):
+        redis_db = fakeredis.FakeStrictRedis()
+        cache = RedisCache(redis_db)
+        now = time.time()
+        cache.set('list', {'data': 1}, now - 1, tags=['posts:list'])
+        cache.set('page', {'data': 2}, now + 60, tags=['posts:list', 'posts:2'])
+        self.assertEqual(redis_db.zrange('fastpass|tag|posts:list', 0, -1), [b'page'])
+        cache.set('other', {'data': 3}, now - 1, tags=['posts:3'])
+        self.assertEqual(cache.purge_tags(['posts:2', 'posts:3']), 1)
+        self.assertIsNone(cache.get('page'))
+
+
+class TestPurge(unittest.TestCase):
+    def test_invalid_requests(self):
+        app = fastpass.app.test_client()
+        for data in ({'posts': 3}, {'posts': [{'id': 3}]}, {'cpt': ['event']}, {'cpt': {'event': 45}},
+                     {'tags': 'news'}):
+            data['status'] = 'NOT_FULL_OF_SHIT'
+            self.assertEqual(app.post('/purge', json=data).status_code, 400, data)
+        self.assertEqual(app.post('/purge', json=[]).status_code, 401)
+        response = app.post('/purge', json={'status': 'NOT_FULL_OF_SHIT', 'posts': ['3'], 'cpt': {'event': [45]}})
+        self.assertEqual(response.get_json(), {'purged': 0})
+
+
+class TestBatch(unittest.TestCase):
+    def test_bodies_spliced_by_path(self):
+        def fail():
+            raise ValueError('broken')
+
+        views = fastpass.app.view_functions
+        saved = dict(views)
+        views['ntunes'] = lambda: Response(b'', mimetype='application/json')
+        views['root_page'] = lambda: '<p>"hi"</p>'
+        views['settings_call'] = fail
+        views['live365'] = lambda: Response(b'{"listeners":3}\n', mimetype='application/json')
+        try:
+            response = fastpass.app.test_client().get('/batch?path=/ntunes&path=/&path=/settings&path=/live365'
+                                                      '&path=/missing&path=/ntunes')
+        finally:
+            views.update(saved)
+        data = response.get_json()
+        self.assertEqual(list(data), ['/ntunes', '/', '/settings', '/live365', '/missing'])
+        self.assertEqual(data['/ntunes'], {'data': None, 'status': 200})
+        self.assertEqual(data['/'], {'data': '<p>"hi"</p>', 'status': 200})
+        self.assertEqual(data['/settings'], {'data': None, 'status': 500})
+        self.assertEqual(data['/live365'], {'data': {'listeners': 3}, 'status': 200})
+        self.assertEqual(data['/missing']['status'], 404)
+        self.assertIsInstance(data['/missing']['data'], str)
+        self.assertEqual(fastpass.app.test_client().get('/batch?path=/batch').status_code, 400)
+
+
+class TestRemovePlayer(unittest.TestCase):
+    FIXTURES = [
+        '<p>Episode &#8220;notes&#8221; &amp; more&hellip;</p>\n'
+        '<div class="powerpress_player" id="powerpress_player_1"><audio controls="controls">'
+        '<source type="audio/mpeg" src="https://example.com/ep.mp3?_=1" /></audio></div>'
+        '<p class="powerpress_links powerpress_links_mp3">Podcast: '
+        '<a href="https://example.com/ep.mp3" class="powerpress_link_pinw" rel="nofollow">Play</a> | '
+        '<a href="https://example.com/ep.mp3?a=1&amp;b=2" class="powerpress_link_d" download="ep.mp3">Download</a></p>',
+        '<p><img class="aligncenter  size-large" src="a.jpg" alt=\'say "hi"\'><br>Line<br/>two</br></p>\n\n'
+        '<a class="powerpress_link_d" href="x.mp3">x</a>',
+        '<pre>  keep  </pre> <!-- note --> <script>if (a < b && c) {}</script><span/>&foo; &copy &#xzz; a < b',
+        '<ul><li>one<li>two</ul></div><p data-x="1" data-x="2"><em>unclosed',
+        '<!DOCTYPE html><p class="powerpress_links">gone</p><a class="powerpress_link_d" href="d.mp3">d</a>',
+        '<p>No player here</p>',
+    ]
+
+    def test_matches_beautifulsoup(self):
+        for content in self.FIXTURES:
+            self.assertEqual(remove_player(content), remove_player_soup(content))
+
+
+class TestFormatPool(unittest.TestCase):
+    def test_pool_matches_serial(self):
+        posts = [{'id': x, 'guid': {'rendered': 'https://podcasts.wdwnt.com/?p={}'.format(x)},
+                  'title': {'rendered': 'Episode &#8220;{}&#8221;'.format(x)}, 'date_gmt': '2020-01-01T00:00:00',
+                  'content': {'rendered': TestRemovePlayer.FIXTURES[x % len(TestRemovePlayer.FIXTURES)]},
+                  '_embedded': {'author': [{'name': 'Tom'}], 'wp:term': [[{'name': 'News &amp; more'}]]}}
+                 for x in range(12)]
+        serial = fastpass.format_wp(posts, with_content=True, with_player=False)
+        saved = fastpass.FORMAT_WORKERS, fastpass.FORMAT_MIN_POSTS, fastpass.format_executor
+        fastpass.FORMAT_WORKERS, fastpass.FORMAT_MIN_POSTS, fastpass.format_executor = 2, 1, None
+        try:
+            pooled = fastpass.format_wp(posts, with_content=True, with_player=False)
+            projected = fastpass._project_podcast_posts(fastpass.format_wp(posts, with_content=True), True, False)
+            executor = fastpass.format_executor
+        finally:
+            if fastpass.format_executor is not None:
+                fastpass.format_executor.shutdown()
+            fastpass.FORMAT_WORKERS, fastpass.FORMAT_MIN_POSTS, fastpass.format_executor = saved
+        self.assertIsInstance(executor, ProcessPoolExecutor)
+        self.assertEqual(pooled, serial)
+        self.assertEqual(projected, serial)
+
+
+class TestSearchIndex(unittest.TestCase):
+    def test_date_order_and_window(self):
+        index = SearchIndex(max_docs=3)
+        index.add(1, '2020-01-01T00:00:00', {'id': 1}, {'title': 'Tron coaster'})
+        index.add(2, '2020-01-02T00:00:00', {'id': 2}, {'title': 'Coaster news', 'content': 'TRON Lightcycle'})
+        index.add(3, '2020-01-03T00:00:00', {'id': 3}, {'title': 'Electronic coasters open'})
+        self.assertIsNone(index.search('coaster', per_page=1))
+        index.add_page(2, 1, '2020-01-02T00:00:00')
+        self.assertIsNone(index.search('coaster', per_page=1))
+        index.add_page(1, 1, '2020-01-03T00:00:00')
+        self.assertEqual(index.search('tron coaster', per_page=1), [{'id': 3}])
+        self.assertIsNone(index.search('tron coaster', per_page=2))
+        index.add_page(2, 1, '2020-01-02T00:00:00')
+        self.assertEqual(index.search('tron coaster', per_page=2), [{'id': 3}, {'id': 2}])
+        self.assertEqual(index.search('coaster', per_page=1, page=2), [{'id': 2}])
+        self.assertIsNone(index.search('coaster', per_page=1, page=3))
+        self.assertIsNone(index.search('lightcycle news', per_page=2))
+        index.remove(3)
+        self.assertIsNone(index.search('coaster', per_page=1))
+
+    def test_pages_of_a_query_line_up(self):
+        def post(post_id):
+            return {'id': post_id, 'guid': {'rendered': 'https://wdwnt.com/?p={}'.format(post_id)},
+                    'title': {'rendered': 'Tron {}'.format(post_id)},
+                    'date_gmt': '2020-01-0{}T00:00:00'.format(post_id),
+                    'content': {'rendered': '<p>Ride</p>'}, 'excerpt': {'rendered': ''}, '_links': {}}
+
+        def respond(url, headers):
+            return FakeResponse(200, [post(1)] if 'search=' in url else [post(3), post(2)])
+
+        client = FakeClient(respond)
+        saved = fastpass.cache, fastpass.http_client, fastpass.search_index
+        fastpass.cache, fastpass.http_client, fastpass.search_index = MemoryCache(), client, SearchIndex()
+        try:
+            app = fastpass.app.test_client()
+            app.get('/posts?per_page=2&page=1')
+            self.assertIn('_fields=', client.urls[0])
+            self.assertIn('excerpt', client.urls[0])
+            page_1 = app.get('/posts?search=tron&per_page=2&page=1').get_json()
+            self.assertEqual(([x['id'] for x in page_1], len(client.urls)), ([3, 2], 1))
+            page_2 = app.get('/posts?search=tron&per_page=2&page=2').get_json()
+            self.assertEqual([x['id'] for x in page_2], [1])
+            self.assertIn('search=tron&per_page=2&page=2&orderby=date', client.urls[1])
+        finally:
+            fastpass.cache, fastpass.http_client, fastpass.search_index = saved
+
+
+class TestChangeIndex(unittest.TestCase):
+    def test_changes_after_cursor(self):
+        index = ChangeIndex(max_posts=3)
+        for post_id, modified in ((1, '2020-01-01T00:00:00'), (2, '2020-01-02T00:00:00'),
+                                  (3, '2020-01-02T00:00:00'), (4, '2020-01-03T00:00:00')):
+            index.add(post_id, modified, {'id': post_id})
+        index.add(2, '2019-01-01T00:00:00', {'id': 2, 'old': True})
+        since = parse_cursor('2020-01-02T00:00:00_2')
+        self.assertEqual([item for _, item in index.changes(since, 10)], [{'id': 3}, {'id': 4}])
+        self.assertEqual(sorted(index.posts), [2, 3, 4])
+        index.mark_complete(since)
+        self.assertTrue(index.fresh(60))
+        self.assertEqual(index.complete_since, since)
+        index.mark_complete(parse_cursor('2020-01-03T00:00:00'))
+        self.assertEqual(index.complete_since, since)
+        index.mark_complete(('2020-01-03T00:00:00', ChangeIndex.MAX_ID), replace=True)
+        self.assertGreater(index.complete_since, since)
+        self.assertRaises(ValueError, parse_cursor, '2020-01-01')
+
+    def test_sync_page_size(self):
+        index = ChangeIndex()
+        for post_id in (1, 2, 3):
+            index.add(post_id, '2020-01-0{}T00:00:00'.format(post_id), {'id': post_id})
+        index.mark_complete(('2020-01-01T00:00:00', 0))
+        saved, fastpass.change_index = fastpass.change_index, index
+        try:
+            app = fastpass.app.test_client()
+            for per_page, ids in (('-1', [1]), ('0', [1]), ('2', [1, 2]), ('1000', [1, 2, 3])):
+                data = app.get('/posts/sync?cursor=2020-01-01T00:00:00&per_page=' + per_page).get_json()
+                self.assertEqual([x['id'] for x in data['posts']], ids)
+        finally:
+            fastpass.change_index = saved
+
+
+class TestEventHub(unittest.TestCase):
+    def test_publishes_changes_only(self):
+        entries = [{'etag': 'a', 'body': b'{"a":1}\n', 'expire_at': 0}] * 2 + \
+                  [{'etag': 'b', 'body': b'{"b":2}\n', 'expire_at': time.time() + 60}]
+        hub = EventHub({'live365': lambda: entries.pop(0)}, min_interval=5)
+        self.assertLess(hub.poll('live365'), time.time() + 6)
+        hub.poll('live365')
+        self.assertEqual(hub.published, 1)
+        self.assertGreater(hub.poll('live365'), time.time() + 50)
+        self.assertEqual(hub.published, 2)
+        self.assertEqual(hub.latest['live365'], ('b', 'event: live365\ndata: {"b":2}\n\n'))
+
+
+class TestYoutubeBroadcasts(unittest.TestCase):
+    class Request(object):
+        def __init__(self, items):
+            self.items = items
+
+        def execute(self):
+            return {'items': self.items}
+
+    class LiveBroadcasts(object):
+        STATUSES = {'active': ('live', 'liveStarting'), 'upcoming': ('created', 'ready', 'testing'),
+                    'completed': ('complete',)}
+
+        def __init__(self, broadcasts):
+            self.broadcasts = broadcasts
+            self.calls = []
+
+        def list(self, part, maxResults, broadcastStatus=None, id=None):
+            self.calls.append(broadcastStatus or 'id')
+            items = list(self.broadcasts.values())
+            if id is not None:
+                items = [x for x in items if x['id'] in id.split(',')]
+            elif broadcastStatus != 'all':
+                items = [x for x in items if x['status']['lifeCycleStatus'] in self.STATUSES[broadcastStatus]]
+            items.sort(key=lambda x: x['snippet']['scheduledStartTime'], reverse=True)
+            return TestYoutubeBroadcasts.Request(items[:maxResults])
+
+        def list_next(self, request, response):
+            return None
+
+    @staticmethod
+    def broadcast(broadcast_id, status, hours):
+        start = datetime.now(timezone.utc) + timedelta(hours=hours)
+        return {'id': broadcast_id, 'snippet': {'scheduledStartTime': start.isoformat(), 'title': broadcast_id},
+                'status': {'lifeCycleStatus': status, 'privacyStatus': 'public'}}
+
+    def test_incremental_refresh(self):
+        broadcasts = {'old': self.broadcast('old', 'complete', -24), 'next': self.broadcast('next', 'ready', 2)}
+        service = self.LiveBroadcasts(broadcasts)
+        yb = YoutubeBroadcasts('id', 'secret', 'token', completed_results=1)
+        yb.service = type('Service', (object,), {'liveBroadcasts': lambda self: service})()
+        yb._execute = lambda request: request.execute()
+
+        self.assertEqual([x['id'] for x in yb.get_broadcasts()['upcoming']], ['next'])
+        broadcasts['next'] = self.broadcast('next', 'live', 0)
+        self.assertEqual([x['id'] for x in yb.get_broadcasts()['live']], ['next'])
+        # Ends, and another one starts and ends before the next refresh.
+        broadcasts['next'] = self.broadcast('next', 'complete', 0)
+        broadcasts['quick'] = self.broadcast('quick', 'complete', 1)
+        result = yb.get_broadcasts()
+        self.assertEqual(([x['id'] for x in result['completed']], result['live']), (['quick'], []))
+        self.assertEqual(service.calls, ['all', 'active', 'upcoming', 'completed', 'active', 'upcoming',
+                                         'completed', 'id'])
+        self.assertEqual(yb._current, {})
+
+
+class TestSlackQueue(unittest.TestCase):
+    def test_batches_retries_and_dedup(self):
+        class Dedup(object):
+            def __init__(self):
+                self.keys = set()
+
+            def claim(self, key):
+                if key in self.keys:
+                    return False
+                self.keys.add(key)
+                return True
+
+            def release(self, key):
+                self.keys.discard(key)
+
+        class Messenger(object):
+            def __init__(self):
+                self.calls = []
+
+            def send(self, msg, channel, username, icon_emoji):
+                self.calls.append((msg, channel))
+                if len(self.calls) == 1:
+                    raise ValueError('Slack is down')
+
+        messenger, dedup = Messenger(), Dedup()
+        slack_queue = SlackQueue(messenger, dedup=dedup, batch_seconds=0.1, backoff_seconds=0)
+        self.assertTrue(slack_queue.enqueue('one', 'alerts', key='1'))
+        self.assertTrue(slack_queue.enqueue('two', 'alerts', key='2'))
+        self.assertFalse(slack_queue.enqueue('one again', 'alerts', key='1'))
+        slack_queue.join()
+        self.assertEqual(messenger.calls, [('one\ntwo', 'alerts')] * 2)
+        self.assertEqual(slack_queue.stats()['sent'], 2)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,54 @@
+# Formatters run by the format pool.  Its processes import only this
+# module, so it must not do anything when imported.
+import html
+from urllib.parse import urlparse
+
+from powerpress import remove_player
+
+
+def format_wp_post(post, with_content=False, with_player=True):
+    raw_url = urlparse(post.get('guid', {}).get('rendered', ''))
+    obj = dict(author={})
+    obj['id'] = post.get('id')
+    obj['short_URL'] = 'https://{}/?p={}'.format(raw_url.netloc, obj['id'])
+    obj['title'] = html.unescape(post.get('title', {}).get('rendered', ''))
+    obj['date'] = post.get('date_gmt')
+    authors = post.get('_embedded', {}).get('author', [])
+    obj['author']['name'] = ','.join([x.get('name', '') for x in authors])
+
+    media = post.get('_embedded', {}).get('wp:featuredmedia', [])
+    if media:
+        obj['featured_image'] = media[0].get('source_url')
+    else:
+        obj['featured_image'] = ''
+
+    term = post.get('_embedded', {}).get('wp:term', [])
+    if term:
+        try:
+            term_val = term[0][0].get('name', '')
+            obj['category'] = html.unescape(term_val)
+        except KeyError:
+            obj['category'] = ''
+    else:
+        obj['category'] = ''
+
+    if with_content:
+        raw_content = post.get('content', {}).get('rendered', '')
+        if with_player:
+            obj['content'] = raw_content
+        else:
+            content, media_url = remove_player(raw_content)
+            obj['content'] = content
+            obj['media_url'] = media_url
+    return obj
+
+
+def project_podcast_post(post, with_content=True, with_player=True):
+    # Turns a format_wp(with_content=True, with_player=True) post into the
+    # post format_wp gives for the other content/player combinations.
+    obj = dict(post)
+    if not with_content:
+        obj.pop('content', None)
+    elif not with_player:
+        obj['content'], obj['media_url'] = remove_player(obj['content'])
+    return obj
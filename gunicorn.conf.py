@@ -0,0 +1,9 @@
+import os
+
+# FASTPASS_WORKER_CLASS=gevent serves requests on cooperative greenlets.
+# gunicorn patches sockets, threads and sleeps in each worker, so a request
+# waiting on WordPress, YouTube or Redis yields to the other requests instead
+# of blocking the worker and one process can hold hundreds of cache misses.
+worker_class = os.getenv('FASTPASS_WORKER_CLASS', 'sync')
+worker_connections = int(os.getenv('FASTPASS_WORKER_CONNECTIONS', 500))
+timeout = int(os.getenv('FASTPASS_WORKER_TIMEOUT_SECONDS', 30))
@@ -0,0 +1,253 @@
+import argparse
+import re
+import timeit
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup
+from bs4.dammit import EntitySubstitution, UnicodeDammit
+
+
+# Tree building rules of BeautifulSoup's html.parser builder that affect
+# what str(soup) looks like.
+VOID_TAGS = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link',
+                       'menuitem', 'meta', 'param', 'source', 'track', 'wbr', 'basefont', 'bgsound',
+                       'command', 'frame', 'image', 'isindex', 'nextid', 'spacer'])
+PRESERVE_WHITESPACE_TAGS = frozenset(['pre', 'textarea'])
+CDATA_TAGS = frozenset(['script', 'style'])
+LIST_ATTRIBUTES = {
+    '*': frozenset(['class', 'accesskey', 'dropzone']),
+    'a': frozenset(['rel', 'rev']),
+    'link': frozenset(['rel', 'rev']),
+    'td': frozenset(['headers']),
+    'th': frozenset(['headers']),
+    'form': frozenset(['accept-charset']),
+    'object': frozenset(['archive']),
+    'area': frozenset(['rel']),
+    'icon': frozenset(['sizes']),
+    'iframe': frozenset(['sandbox']),
+    'output': frozenset(['for']),
+}
+ASCII_SPACES = frozenset('\x20\x0a\x09\x0c\x0d')
+NON_WHITESPACE = re.compile(r'\S+')
+XML_SPECIAL = re.compile(r'[&<>]')
+XML_ENTITIES = {'&': '&amp;', '<': '&lt;', '>': '&gt;'}
+
+# Elements dropped from podcast content, as (tag, class) pairs.
+PLAYER_ELEMENTS = (('div', 'powerpress_player'), ('p', 'powerpress_links'))
+DOWNLOAD_LINK = ('a', 'powerpress_link_d')
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _escape(text):
+    return XML_SPECIAL.sub(lambda m: XML_ENTITIES[m.group(0)], text)
+
+
+def _quote(value):
+    value = _escape(value)
+    if '"' in value:
+        if "'" in value:
+            return '"' + value.replace('"', '&quot;') + '"'
+        return "'" + value + "'"
+    return '"' + value + '"'
+
+
+class PlayerStripper(HTMLParser):
+    """Single pass equivalent of remove_player_soup().
+
+    Tokenizes the content with the same HTMLParser setup BeautifulSoup's
+    html.parser builder uses and writes the markup back out the way
+    str(soup) would, without building a tree.  Player elements are skipped
+    while open and the first download link is remembered on the way.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.out = []
+        self.data = []
+        self.stack = []
+        self.open_counts = {}
+        self.preserve_depth = 0
+        self.already_closed = []
+        self.skip_depth = 0
+        self.download_url = None
+
+    def _emit(self, text):
+        if not self.skip_depth:
+            self.out.append(text)
+
+    def _end_data(self):
+        if not self.data:
+            return
+        text = ''.join(self.data)
+        self.data = []
+        if not self.preserve_depth and all(c in ASCII_SPACES for c in text):
+            text = '\n' if '\n' in text else ' '
+        if not (self.stack and self.stack[-1] in CDATA_TAGS):
+            text = _escape(text)
+        self._emit(text)
+
+    def _push(self, tag, skip):
+        self.stack.append(tag)
+        self.open_counts[tag] = self.open_counts.get(tag, 0) + 1
+        if tag in PRESERVE_WHITESPACE_TAGS:
+            self.preserve_depth += 1
+        if skip and not self.skip_depth:
+            self.skip_depth = len(self.stack)
+
+    def _pop(self):
+        tag = self.stack.pop()
+        self.open_counts[tag] -= 1
+        if tag in PRESERVE_WHITESPACE_TAGS:
+            self.preserve_depth -= 1
+        if tag not in VOID_TAGS:
+            self._emit('</{}>'.format(tag))
+        if self.skip_depth > len(self.stack):
+            self.skip_depth = 0
+
+    def _close_to(self, tag):
+        # Same as BeautifulSoup._popToTag: close everything up to and
+        # including the most recent open tag of this name, if any.
+        if not self.open_counts.get(tag):
+            return
+        while self.stack:
+            top = self.stack[-1]
+            self._pop()
+            if top == tag:
+                break
+
+    def handle_starttag(self, tag, attrs, empty_element=True):
+        if tag == 'meta':
+            # BeautifulSoup rewrites declared charsets on output.
+            raise _Unsupported(tag)
+        self._end_data()
+        attr_dict = {}
+        for key, value in attrs:
+            attr_dict[key] = '' if value is None else value
+        classes = attr_dict.get('class', '').split()
+        if self.download_url is None and tag == DOWNLOAD_LINK[0] and \
+                (DOWNLOAD_LINK[1] in classes or attr_dict.get('class') == DOWNLOAD_LINK[1]):
+            self.download_url = attr_dict.get('href', '')
+        skip = any(tag == t and c in classes for t, c in PLAYER_ELEMENTS)
+
+        list_attrs = LIST_ATTRIBUTES['*'] | LIST_ATTRIBUTES.get(tag, frozenset())
+        parts = []
+        for key in sorted(attr_dict):
+            value = attr_dict[key]
+            if key in list_attrs:
+                value = ' '.join(NON_WHITESPACE.findall(value))
+            parts.append('{}={}'.format(key, _quote(value)))
+        attr_string = ' ' + ' '.join(parts) if parts else ''
+
+        self._push(tag, skip)
+        if tag in VOID_TAGS:
+            self._emit('<{}{}/>'.format(tag, attr_string))
+            if empty_element:
+                self._close_to(tag)
+                self.already_closed.append(tag)
+        else:
+            self._emit('<{}{}>'.format(tag, attr_string))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, empty_element=False)
+        self._end_data()
+        self._close_to(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self.already_closed:
+            self.already_closed.remove(tag)
+            return
+        self._end_data()
+        self._close_to(tag)
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_charref(self, name):
+        base, pattern = 10, r'^([0-9]+)(.*)'
+        if name[:1] in ('x', 'X'):
+            name, base, pattern = name[1:], 16, r'^([0-9a-f]+)(.*)'
+        extra = ''
+        try:
+            number = int(name, base)
+        except ValueError:
+            match = re.search(pattern, name)
+            if match is None:
+                self.data.append(name)
+                return
+            number, extra = int(match.group(1), base), match.group(2)
+        self.data.append(UnicodeDammit.numeric_character_reference(number)[0])
+        self.data.append(extra)
+
+    def handle_entityref(self, name):
+        character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+        self.data.append(character if character is not None else '&' + name)
+
+    def handle_comment(self, data):
+        self._end_data()
+        self.data.append(data)
+        text = ''.join(self.data)
+        self.data = []
+        if not self.preserve_depth and all(c in ASCII_SPACES for c in text):
+            text = '\n' if '\n' in text else ' '
+        self._emit('<!--{}-->'.format(text))
+
+    def handle_decl(self, decl):
+        raise _Unsupported(decl)
+
+    def handle_pi(self, data):
+        raise _Unsupported(data)
+
+    def unknown_decl(self, data):
+        raise _Unsupported(data)
+
+    def close(self):
+        super().close()
+        self._end_data()
+        while self.stack:
+            self._pop()
+
+
+def remove_player_soup(wp_content):
+    soup = BeautifulSoup(wp_content, "html.parser")
+
+    link = soup.find('a', class_='powerpress_link_d')
+    download_url = link.get('href', '') if link is not None else ''
+    for tag in soup.select('div.powerpress_player'):
+        tag.decompose()
+    for tag in soup.select('p.powerpress_links'):
+        tag.decompose()
+    return str(soup), download_url
+
+
+def remove_player(wp_content):
+    """Drop the PowerPress player and links from post content.
+
+    Returns the remaining markup, serialized exactly as remove_player_soup()
+    does, and the href of the first PowerPress download link.
+    """
+    stripper = PlayerStripper()
+    try:
+        stripper.feed(wp_content)
+        stripper.close()
+    except _Unsupported:
+        return remove_player_soup(wp_content)
+    return ''.join(stripper.out), stripper.download_url or ''
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare remove_player with the BeautifulSoup version.')
+    parser.add_argument('files', nargs='+', help='HTML files with podcast post content')
+    parser.add_argument('--number', type=int, default=50, help='Runs per file')
+    args = parser.parse_args()
+
+    for path in args.files:
+        with open(path, encoding='utf-8') as f:
+            content = f.read()
+        same = remove_player(content) == remove_player_soup(content)
+        fast = timeit.timeit(lambda: remove_player(content), number=args.number)
+        slow = timeit.timeit(lambda: remove_player_soup(content), number=args.number)
+        print('{}: identical={} soup={:.2f}ms stream={:.2f}ms speedup={:.1f}x'.format(
+            path, same, slow / args.number * 1000, fast / args.number * 1000, slow / fast))
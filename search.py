@@ -0,0 +1,125 @@
+import re
+import threading
+
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower()) if text else []
+
+
+class SearchIndex(object):
+    """In-process inverted index over the most recent posts seen.
+
+    Documents are added with a sortable ``date``, the ``item`` returned for
+    them and a dict of field texts.  Only the ``max_docs`` newest documents
+    are kept.  Like WordPress' ``?search=`` every query term has to appear
+    in the text, also inside a longer word, and results are ordered newest
+    first like ``?search=&orderby=date``.
+
+    Documents can come from anywhere, so searches only look at the window
+    known to hold every post: ``add_page`` is told about each page of the
+    unfiltered post list, and pages 1 to n seen in order mean every post
+    dated at or after the oldest one on page n is indexed.  A page of
+    results that lies inside the window is the same page WordPress returns.
+    """
+
+    def __init__(self, max_docs=1000):
+        self.max_docs = max_docs
+        self.docs = {}
+        self.postings = {}
+        self.window_since = None
+        self.window_pages = 0
+        self.window_per_page = None
+        self._lock = threading.Lock()
+
+    def add(self, doc_id, date, item, fields):
+        terms = set()
+        for text in fields.values():
+            terms.update(tokenize(text))
+        with self._lock:
+            self._remove(doc_id)
+            self.docs[doc_id] = (date, item, tuple(terms))
+            for term in terms:
+                self.postings.setdefault(term, set()).add(doc_id)
+            if len(self.docs) > self.max_docs:
+                by_date = sorted(self.docs, key=lambda x: self.docs[x][0])
+                for old_id in by_date[:len(self.docs) - self.max_docs]:
+                    self._remove(old_id)
+                oldest = self.docs[by_date[len(by_date) - self.max_docs]][0]
+                if self.window_since is not None and oldest > self.window_since:
+                    self.window_since = oldest
+
+    def _remove(self, doc_id):
+        doc = self.docs.pop(doc_id, None)
+        if doc is None:
+            return
+        for term in doc[2]:
+            postings = self.postings[term]
+            postings.discard(doc_id)
+            if not postings:
+                del self.postings[term]
+
+    def remove(self, doc_id):
+        # The window has a hole until the list is fetched again.
+        with self._lock:
+            self._remove(doc_id)
+            self._reset_window()
+
+    def _reset_window(self):
+        self.window_since = None
+        self.window_pages = 0
+        self.window_per_page = None
+
+    def add_page(self, page, per_page, oldest):
+        """Records that ``page`` of the unfiltered list, whose oldest post is dated ``oldest``, was indexed."""
+        with self._lock:
+            if per_page != self.window_per_page:
+                if page != 1:
+                    return
+                self._reset_window()
+                self.window_per_page = per_page
+            elif page > self.window_pages + 1:
+                return
+            self.window_pages = max(self.window_pages, page)
+            if self.window_since is None or oldest < self.window_since:
+                self.window_since = oldest
+
+    def _matching(self, term):
+        doc_ids = set()
+        for indexed, postings in self.postings.items():
+            if term in indexed:
+                doc_ids.update(postings)
+        return doc_ids
+
+    def search(self, query, per_page=30, page=1):
+        """Return the items for one page of results.
+
+        Returns ``None`` unless the matches inside the window fill the whole
+        page, as posts outside it may match too.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or page < 1 or per_page < 1:
+            return None
+        with self._lock:
+            if self.window_since is None:
+                return None
+            matches = None
+            for term in terms:
+                matches = self._matching(term) if matches is None else matches & self._matching(term)
+            matches = sorted(((self.docs[doc_id][0], doc_id) for doc_id in matches
+                              if self.docs[doc_id][0] >= self.window_since), reverse=True)
+            start = (page - 1) * per_page
+            if start + per_page > len(matches):
+                return None
+            return [self.docs[doc_id][1] for _, doc_id in matches[start:start + per_page]]
+
+    def stats(self):
+        return {
+            'documents': len(self.docs),
+            'terms': len(self.postings),
+            'max_documents': self.max_docs,
+            'window_since': self.window_since,
+            'window_pages': self.window_pages,
+        }
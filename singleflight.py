@@ -0,0 +1,80 @@
+import threading
+
+from redis.exceptions import LockError, RedisError
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Collapse concurrent calls for the same key into one execution.
+
+    Threads in this process that ask for a key while a call for it is
+    already running wait for that call and share its result.  When a Redis
+    client is given, the running call also holds a Redis lock for the key so
+    that other workers wait for it instead of calling upstream themselves.
+    """
+
+    def __init__(self, redis_db=None, lock_timeout=30):
+        self.redis_db = redis_db
+        self.lock_timeout = lock_timeout
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, recheck=None):
+        """Run ``func`` once for ``key`` and return its result to every caller.
+
+        ``recheck`` is called by the leader before ``func`` and should return
+        the already available value (usually a cache read) or ``None``.  This
+        covers the case where another thread or worker filled the cache while
+        the leader was waiting for the lock.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._run(key, func, recheck)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _run(self, key, func, recheck):
+        lock = None
+        if self.redis_db is not None:
+            lock = self.redis_db.lock(f'lock|{key}', timeout=self.lock_timeout,
+                                      blocking_timeout=self.lock_timeout)
+            try:
+                if not lock.acquire():
+                    lock = None
+            except RedisError:
+                lock = None
+        try:
+            if recheck is not None:
+                result = recheck()
+                if result is not None:
+                    return result
+            return func()
+        finally:
+            if lock is not None:
+                try:
+                    lock.release()
+                except (LockError, RedisError):
+                    pass
@@ -1,9 +1,21 @@
 import json
-import requests
 import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from redis.exceptions import RedisError
+
 
 class SlackMessenger(object):
-    def __init__(self, webhook_url=''):
+    def __init__(self, webhook_url='', http=None, timeout=10):
+        # http can be any object with a requests-style post(), e.g. a pooled
+        # UpstreamClient, so messages reuse open connections.
+        self.http = http if http is not None else requests
+        self.timeout = timeout
         if webhook_url:
             self.webhook_url = webhook_url
         else:
@@ -22,10 +34,171 @@ class SlackMessenger(object):
         if channel:
             payload['channel'] = channel
         headers = {'Content-Type': 'application/json'}
-        resp = requests.post(self.webhook_url, data=json.dumps(payload),
-                             headers=headers)
+        resp = self.http.post(self.webhook_url, data=json.dumps(payload),
+                              headers=headers, timeout=self.timeout)
         if resp.status_code != 200:
             raise ValueError(
                 'Request to Slack returned an error {}:\n{}'.format(
                     resp.status_code, resp.text)
-            )
\ No newline at end of file
+            )
+
+
+class RedisDedup(object):
+    """Remembers keys for ``ttl`` seconds in Redis, shared by every worker.
+
+    The prefix is outside the cache's ``fastpass|`` keys so that clearing
+    the cache does not forget which alerts were sent.
+    """
+
+    def __init__(self, redis_db, ttl=604800, prefix='fastpass-slack|'):
+        self.redis_db = redis_db
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def claim(self, key):
+        # True for the first caller only, until the key expires.
+        try:
+            return bool(self.redis_db.set(self.prefix + key, 1, nx=True, ex=self.ttl))
+        except RedisError:
+            return True
+
+    def release(self, key):
+        try:
+            self.redis_db.delete(self.prefix + key)
+        except RedisError:
+            pass
+
+
+class SqliteDedup(object):
+    """Remembers keys for ``ttl`` seconds in a SQLite file.
+
+    Every worker on the host that uses the same ``path`` shares it, and it
+    survives restarts.
+    """
+
+    def __init__(self, path, ttl=604800):
+        self.path = path
+        self.ttl = ttl
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS sent (key TEXT PRIMARY KEY, expire_at REAL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def claim(self, key):
+        now = time.time()
+        db = self._connect()
+        try:
+            with db:
+                db.execute('DELETE FROM sent WHERE expire_at < ?', (now,))
+                cursor = db.execute('INSERT OR IGNORE INTO sent (key, expire_at) VALUES (?, ?)',
+                                    (key, now + self.ttl))
+                return cursor.rowcount == 1
+        except sqlite3.Error:
+            return True
+        finally:
+            db.close()
+
+    def release(self, key):
+        db = self._connect()
+        try:
+            with db:
+                db.execute('DELETE FROM sent WHERE key = ?', (key,))
+        except sqlite3.Error:
+            pass
+        finally:
+            db.close()
+
+
+class SlackQueue(object):
+    """Sends Slack messages from a background thread.
+
+    ``enqueue`` returns right away.  Messages with a ``key`` are claimed in
+    ``dedup`` first and dropped if another worker already sent them.  The
+    thread waits up to ``batch_seconds`` for more messages and posts the
+    ones for the same channel as one message of at most ``batch_size``
+    lines.  Failed posts are retried ``retries`` times, ``backoff_seconds``
+    doubling each time; after that their keys are released so they can be
+    sent again later.
+    """
+
+    def __init__(self, messenger, dedup=None, batch_size=10, batch_seconds=2,
+                 retries=5, backoff_seconds=1):
+        self.messenger = messenger
+        self.dedup = dedup
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.queue = queue.Queue()
+        self.sent = 0
+        self.failed = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def enqueue(self, msg, channel='', username='Bob Chapek Slack Bot',
+                icon_emoji=':haha:', key=None):
+        if key is not None and self.dedup is not None and not self.dedup.claim(key):
+            return False
+        self.queue.put((key, msg, channel, username, icon_emoji))
+        with self._lock:
+            # Started on first use so it runs in the worker, not a parent
+            # process that forks workers later.
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='slack-queue', daemon=True)
+                self._thread.start()
+        return True
+
+    def join(self):
+        self.queue.join()
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.batch_seconds
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            groups = OrderedDict()
+            for key, msg, channel, username, icon_emoji in batch:
+                groups.setdefault((channel, username, icon_emoji), []).append((key, msg))
+            for (channel, username, icon_emoji), items in groups.items():
+                for i in range(0, len(items), self.batch_size):
+                    self._deliver(channel, username, icon_emoji, items[i:i + self.batch_size])
+            for _ in batch:
+                self.queue.task_done()
+
+    def _deliver(self, channel, username, icon_emoji, items):
+        text = '\n'.join(msg for _, msg in items)
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff_seconds * 2 ** (attempt - 1))
+            try:
+                self.messenger.send(text, channel, username, icon_emoji)
+                self.sent += len(items)
+                return
+            except Exception as e:
+                error = e
+        self.failed += len(items)
+        print('Slack delivery to {} failed after {} attempts: {}'.format(channel, self.retries + 1, error))
+        if self.dedup is not None:
+            for key, _ in items:
+                if key is not None:
+                    self.dedup.release(key)
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'sent': self.sent,
+            'failed': self.failed,
+        }
@@ -0,0 +1,70 @@
+import re
+import threading
+import time
+
+
+CURSOR_RE = re.compile(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(_\d+)?$')
+
+
+def make_cursor(modified, post_id=0):
+    return '{}_{}'.format(modified, post_id)
+
+
+def parse_cursor(cursor):
+    """Split a cursor into its sortable ``(modified, id)`` key."""
+    if not CURSOR_RE.match(cursor or ''):
+        raise ValueError('Invalid cursor {}'.format(cursor))
+    modified, _, post_id = cursor.partition('_')
+    return modified, int(post_id or 0)
+
+
+class ChangeIndex(object):
+    """Post ids ordered by modification time, for incremental sync.
+
+    Posts are added from any fetch with their ``modified`` timestamp and
+    the ``item`` to return for them.  ``mark_complete(since)`` records that
+    every post modified after ``since`` has been added, as of now; only
+    cursors at or after that point can be answered from the index.  With
+    ``replace`` the posts before ``since`` are no longer known to be
+    complete.  At most ``max_posts`` of the most recently modified posts
+    are kept.
+    """
+
+    # Sorts after every post id, for keys covering a whole timestamp.
+    MAX_ID = 2 ** 63
+
+    def __init__(self, max_posts=1000):
+        self.max_posts = max_posts
+        self.posts = {}
+        self.complete_since = None
+        self.checked_at = 0
+        self._lock = threading.Lock()
+
+    def add(self, post_id, modified, item):
+        with self._lock:
+            current = self.posts.get(post_id)
+            if current is not None and current[0] > modified:
+                return
+            self.posts[post_id] = (modified, item)
+            if len(self.posts) > self.max_posts:
+                by_key = sorted((v[0], k) for k, v in self.posts.items())
+                evicted = by_key[:len(self.posts) - self.max_posts]
+                for _, old_id in evicted:
+                    del self.posts[old_id]
+                if self.complete_since is not None and evicted[-1] > self.complete_since:
+                    self.complete_since = evicted[-1]
+
+    def mark_complete(self, since, replace=False):
+        with self._lock:
+            if replace or self.complete_since is None or since < self.complete_since:
+                self.complete_since = since
+            self.checked_at = time.time()
+
+    def fresh(self, max_age):
+        return self.complete_since is not None and time.time() - self.checked_at <= max_age
+
+    def changes(self, since, limit):
+        """Return up to ``limit`` ``(key, item)`` pairs modified after ``since``, oldest first."""
+        with self._lock:
+            changed = sorted(((v[0], k), v[1]) for k, v in self.posts.items() if (v[0], k) > since)
+        return changed[:limit]
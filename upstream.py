@@ -0,0 +1,36 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class UpstreamClient(object):
+    """Keep-alive HTTP client shared by every upstream call.
+
+    Connections are pooled per host (up to ``pool_hosts`` hosts with
+    ``pool_size`` connections each), every request gets a default
+    ``(connect, read)`` timeout and idempotent requests are retried with
+    exponential backoff on connection errors and 502/503/504 responses.
+    """
+
+    def __init__(self, pool_hosts=10, pool_size=10, connect_timeout=3.05,
+                 read_timeout=5, retries=2, backoff_factor=0.3):
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset(['GET', 'HEAD']),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
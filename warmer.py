@@ -0,0 +1,86 @@
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+class CacheWarmer(object):
+    """Refresh hot request paths shortly before their cache entries expire.
+
+    Hot paths are the ``paths`` given here plus the ``top_n`` most requested
+    paths seen through ``record()``.  Every ``interval`` seconds each hot path
+    whose entry expires within ``lead_seconds`` (plus up to ``jitter_seconds``
+    of random spread) is handed to ``warm(path)``, at most ``concurrency`` at
+    a time.  ``expire_at(key)`` returns the expiry timestamp of a cache key,
+    or ``None`` when it is not cached.
+    """
+
+    MAX_TRACKED_PATHS = 1000
+
+    def __init__(self, warm, expire_at, paths=(), top_n=20, interval=10,
+                 lead_seconds=20, jitter_seconds=10, concurrency=2):
+        self.warm = warm
+        self.expire_at = expire_at
+        self.paths = list(paths)
+        self.top_n = top_n
+        self.interval = interval
+        self.lead_seconds = lead_seconds
+        self.jitter_seconds = jitter_seconds
+        self.hits = Counter()
+        self.keys = {}
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._thread = None
+
+    def record(self, path, key, hit=True):
+        with self._lock:
+            if hit:
+                self.hits[path] += 1
+            self.keys[path] = key
+            if len(self.hits) > self.MAX_TRACKED_PATHS:
+                keep = dict(self.hits.most_common(self.MAX_TRACKED_PATHS // 2))
+                self.hits = Counter(keep)
+                self.keys = {k: v for k, v in self.keys.items() if k in keep}
+
+    def hot_paths(self):
+        with self._lock:
+            top = [path for path, _ in self.hits.most_common(self.top_n)]
+        return list(dict.fromkeys(self.paths + top))
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='cache-warmer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                print('Cache warmer failed: {}'.format(e))
+            time.sleep(self.interval)
+
+    def run_once(self):
+        now = time.time()
+        for path in self.hot_paths():
+            key = self.keys.get(path)
+            expire_at = self.expire_at(key) if key is not None else None
+            lead = self.lead_seconds + random.uniform(0, self.jitter_seconds)
+            if expire_at is not None and expire_at - lead > now:
+                continue
+            with self._lock:
+                if path in self._in_flight:
+                    continue
+                self._in_flight.add(path)
+            self._executor.submit(self._warm, path)
+
+    def _warm(self, path):
+        try:
+            self.warm(path)
+        except Exception as e:
+            print('Warming {} failed: {}'.format(path, e))
+        finally:
+            with self._lock:
+                self._in_flight.discard(path)
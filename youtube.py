@@ -1,24 +1,47 @@
 import argparse
+import threading
 # import functools
 from pprint import pprint
 from datetime import datetime, timedelta, timezone
 
+import google_auth_httplib2
+import httplib2
 from dateutil.parser import parse
+from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
 
 class YoutubeBroadcasts(object):
-    def __init__(self, client_id, client_secret, refresh_token):
+    # Instances are meant to be kept and shared between threads: the service
+    # is built once, the access token is reused and refreshed
+    # token_refresh_lead_seconds before it expires, and every thread gets
+    # its own HTTP connection.
+    def __init__(self, client_id, client_secret, refresh_token, token_refresh_lead_seconds=300,
+                 full_refresh_seconds=86400, completed_results=5):
         self.client_id = client_id
         self.client_secret = client_secret
         self.refresh_token = refresh_token
         self.token_uri = 'https://www.googleapis.com/oauth2/v4/token'
         self.api_service_name = 'youtube'
         self.api_version = 'v3'
+        self.token_refresh_lead_seconds = token_refresh_lead_seconds
+        self.full_refresh_seconds = full_refresh_seconds
+        self.completed_results = completed_results
+        self.credentials = Credentials(None, client_id=self.client_id, client_secret=self.client_secret,
+                                       token_uri=self.token_uri, refresh_token=self.refresh_token)
+        self._token_lock = threading.Lock()
+        self._local = threading.local()
         self.service = self._get_authenticated_service()
         self.valid_statuses = ('active', 'upcoming',)
+        # Broadcast state kept between refreshes: broadcasts that are not
+        # over yet and the latest completed one per privacy status, both as
+        # (parsed air time, obj) pairs.
+        self._state_lock = threading.Lock()
+        self._bootstrapped_at = None
+        self._current = {}
+        self._completed = {}
         self.upload_playlist_id = 'UURIVd5Ci1bTQqJB_T4q_Jgg'
 
     def _get_authenticated_service(self):
@@ -26,16 +49,34 @@ class YoutubeBroadcasts(object):
         # For oAuth2, a Web Application client needs to be created
         # See https://google-auth.readthedocs.io/en/latest/reference/google.oauth2.credentials.html
         # A token is not required if there is a token_uri and refresh_token
+        # The discovery document bundled with googleapiclient is used instead
+        # of downloading it.
+        return build(self.api_service_name, self.api_version, credentials=self.credentials,
+                     static_discovery=True, cache_discovery=False)
 
-        credentials = Credentials(None, client_id=self.client_id, client_secret=self.client_secret,
-                                  token_uri=self.token_uri, refresh_token=self.refresh_token)
-        return build(self.api_service_name, self.api_version, credentials=credentials)
+    def _ensure_token(self):
+        with self._token_lock:
+            expiry = self.credentials.expiry
+            lead = timedelta(seconds=self.token_refresh_lead_seconds)
+            if not self.credentials.token or expiry is None or expiry - datetime.utcnow() < lead:
+                self.credentials.refresh(Request())
+
+    def _execute(self, request):
+        # httplib2 connections are not thread safe, keep one per thread.
+        self._ensure_token()
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._local.http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http())
+        return request.execute(http=http)
 
     # Retrieve a list of broadcasts with the specified status.
-    def list_broadcasts(self, broadcast_status='all', debug=False):
+    def list_broadcasts(self, broadcast_status='all', debug=False, max_results=None):
         # print('Broadcasts with status "{}":'.format(broadcast_status))
+        # With max_results only the first page is listed.
 
-        max_results = 7 if debug else 50
+        first_page_only = debug or max_results is not None
+        if max_results is None:
+            max_results = 7 if debug else 50
 
         list_broadcasts_request = self.service.liveBroadcasts().list(
             broadcastStatus=broadcast_status,
@@ -45,19 +86,30 @@ class YoutubeBroadcasts(object):
 
         result = []
         while list_broadcasts_request:
-            list_broadcasts_response = list_broadcasts_request.execute()
+            list_broadcasts_response = self._execute(list_broadcasts_request)
 
             for broadcast in list_broadcasts_response.get('items', []):
                 # print('{} ({})'.format(broadcast['snippet']['title'], broadcast['id']))
                 result.append(broadcast)
 
-            if debug:
+            if first_page_only:
                 break
 
             list_broadcasts_request = self.service.liveBroadcasts().list_next(
                 list_broadcasts_request, list_broadcasts_response)
         return result
 
+    def list_broadcasts_by_id(self, ids):
+        result = []
+        for i in range(0, len(ids), 50):
+            list_broadcasts_request = self.service.liveBroadcasts().list(
+                id=','.join(ids[i:i + 50]),
+                part='id,snippet,contentDetails,status',
+                maxResults=50
+            )
+            result.extend(self._execute(list_broadcasts_request).get('items', []))
+        return result
+
     def list_uploads(self, last_n_minutes=5, only_unlisted=True):
         upload_request = self.service.playlistItems().list(
             part='snippet,status',
@@ -68,7 +120,7 @@ class YoutubeBroadcasts(object):
         now = datetime.now(timezone.utc)
         cutoff = now - timedelta(minutes=last_n_minutes)
         while upload_request:
-            upload_response = upload_request.execute()
+            upload_response = self._execute(upload_request)
             upload_request = self.service.playlistItems().list_next(
                 upload_request, upload_response)
             for upload in upload_response.get('items', []):
@@ -80,49 +132,94 @@ class YoutubeBroadcasts(object):
             return [x for x in result if x['status']['privacyStatus'] == 'unlisted']
         return result
 
+    @staticmethod
+    def _broadcast_obj(broadcast):
+        try:
+            return {'air_time': broadcast['snippet']['scheduledStartTime'],
+                    'title': broadcast['snippet']['title'],
+                    'live_status': broadcast['status']['lifeCycleStatus'],
+                    'privacy': broadcast['status']['privacyStatus'], 'id': broadcast['id']}
+        except:
+            return None
+
     @staticmethod
     def _live_broadcasts(all_broadcasts):
-        return [x for x in all_broadcasts if x['live_status'] in ('live', 'liveStarting')]
+        return [x for _, x in all_broadcasts if x['live_status'] in ('live', 'liveStarting')]
 
     @staticmethod
     def _next_day_upcoming(all_broadcasts):
         today = datetime.now(timezone.utc)
         tomorrow = today + timedelta(days=1)
-        return [x for x in all_broadcasts if x['live_status'] in ('created', 'ready', 'testStarting', 'testing')
-                and parse(x['air_time']) < tomorrow]
+        return [x for air_time, x in all_broadcasts
+                if x['live_status'] in ('created', 'ready', 'testStarting', 'testing') and air_time < tomorrow]
 
     @staticmethod
-    def _last_completed(all_broadcasts):
-        return max(filter(lambda x: x['live_status'] == 'complete', all_broadcasts),
-                   key=lambda x: parse(x['air_time']),default=0)
+    def _last_completed(completed_broadcasts):
+        return max(completed_broadcasts, key=lambda x: x[0], default=(None, 0))[1]
+
+    def _apply(self, broadcasts):
+        for x in broadcasts:
+            obj = self._broadcast_obj(x)
+            if obj is None:
+                continue
+            air_time = parse(obj['air_time'])
+            if obj['live_status'] in ('complete', 'revoked'):
+                self._current.pop(obj['id'], None)
+            else:
+                self._current[obj['id']] = (air_time, obj)
+            if obj['live_status'] == 'complete':
+                latest = self._completed.get(obj['privacy'])
+                if latest is None or latest[1]['id'] == obj['id'] or air_time > latest[0]:
+                    self._completed[obj['privacy']] = (air_time, obj)
+
+    def _refresh(self):
+        # Lists every broadcast once (and again every full_refresh_seconds to
+        # catch edits to finished broadcasts), in between only the active and
+        # upcoming ones plus the latest completed ones, which catches
+        # broadcasts that started and ended between two refreshes, and looks
+        # up by id the ones that dropped out of those.
+        now = datetime.now(timezone.utc)
+        if self._bootstrapped_at is None or now - self._bootstrapped_at > timedelta(seconds=self.full_refresh_seconds):
+            all_broadcasts = self.list_broadcasts('all')
+            self._current = {}
+            self._completed = {}
+            self._apply(all_broadcasts)
+            self._bootstrapped_at = now
+            return
+        broadcasts = []
+        for status in self.valid_statuses:
+            broadcasts.extend(self.list_broadcasts(status))
+        broadcasts.extend(self.list_broadcasts('completed', max_results=self.completed_results))
+        listed = set(x['id'] for x in broadcasts)
+        gone = [x for x in self._current if x not in listed]
+        if gone:
+            found = self.list_broadcasts_by_id(gone)
+            for broadcast_id in set(gone) - set(x['id'] for x in found):
+                # Deleted.
+                self._current.pop(broadcast_id)
+            broadcasts.extend(found)
+        self._apply(broadcasts)
 
     def get_broadcasts(self, show_unlisted=False, debug=False):
-        all_broadcasts = []
-        # for status in self.valid_statuses:
-        for status in ('all',):
+        if debug:
             try:
-                all_broadcasts.extend(self.list_broadcasts(status, debug=debug))
+                all_broadcasts = self.list_broadcasts('all', debug=debug)
             except HttpError as e:
                 print('An HTTP error {} occurred:\n{}'.format(e.resp.status, e.content))
-        all_objs = []
-        video_for_id = {}
-        for x in all_broadcasts:
-            if not show_unlisted and x['status']['privacyStatus'] == 'unlisted':
-                continue
+                all_broadcasts = []
+            all_objs = [self._broadcast_obj(x) for x in all_broadcasts]
+            return [x for x in all_objs if x is not None and (show_unlisted or x['privacy'] != 'unlisted')]
+
+        with self._state_lock:
             try:
-                obj = {'air_time': x['snippet']['scheduledStartTime'],
-                       'title': x['snippet']['title'],
-                       'live_status': x['status']['lifeCycleStatus'],
-                       'privacy': x['status']['privacyStatus'], 'id': x['id']}
-                video_for_id[x['id']] = x
-                all_objs.append(obj)
-            except:
-                pass
-        if debug:
-            return all_objs
-        live = self._live_broadcasts(all_objs)
-        upcoming = self._next_day_upcoming(all_objs)
-        completed = self._last_completed(all_objs)
+                self._refresh()
+            except HttpError as e:
+                print('An HTTP error {} occurred:\n{}'.format(e.resp.status, e.content))
+            current = [x for x in self._current.values() if show_unlisted or x[1]['privacy'] != 'unlisted']
+            completed = [x for privacy, x in self._completed.items() if show_unlisted or privacy != 'unlisted']
+        live = self._live_broadcasts(current)
+        upcoming = self._next_day_upcoming(current)
+        completed = self._last_completed(completed)
 
         # In order to comply with Youtube Required Minimum Functionality
         if live: